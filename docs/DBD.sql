@@ -32,18 +32,18 @@ tmdb_id int NULL
 
 collected
 --
-id PK string
-type string NULL
-media_id int FK >- movie.id FK >- episode.id
+type PK string
+media_id PK int FK >- movie.id FK >- episode.id
 collected_at string
+removed_at string NULL
 
 ratings
 --
-id PK string
-type string NULL
-media_id int FK >- movie.id FK >- episode.id FK >- show.id
+type PK string
+media_id PK int FK >- movie.id FK >- episode.id FK >- show.id
 rating int
 rated_at string NULL
+removed_at string NULL
 
 watchlist
 --
@@ -51,6 +51,7 @@ id PK int
 type string NULL
 media_id int FK >- movie.id FK >- show.id
 watchlisted_at string
+removed_at string NULL
 
 watchlog
 --
@@ -59,3 +60,37 @@ type string NULL
 media_id int FK >- movie.id FK >- episode.id
 watched_at string
 
+media_plays
+--
+type PK string
+media_id PK int FK >- movie.id FK >- episode.id
+plays int
+first_watched_at string NULL
+last_watched_at string NULL
+
+daily_plays
+--
+day PK string
+type PK string
+plays int
+
+monthly_plays
+--
+month PK string
+type PK string
+plays int
+
+show_progress
+--
+show_id PK int FK >- show.id
+watched_episodes int
+plays int
+aired_episodes int NULL
+last_watched_at string NULL
+
+genre_time
+--
+genre_id PK string FK >- genre.slug
+type PK string
+plays int
+minutes int
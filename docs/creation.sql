@@ -1,6 +1,6 @@
-CREATE TABLE [collected] ( [id] TEXT PRIMARY KEY NOT NULL, [type]
-TEXT, [media_id] INTEGER NOT NULL, [collected_at] TEXT NOT NULL,
-FOREIGN KEY([media_id]) REFERENCES [movie]([id]), FOREIGN
+CREATE TABLE [collected] ( [type] TEXT NOT NULL, [media_id] INTEGER
+NOT NULL, [collected_at] TEXT NOT NULL, [removed_at] TEXT, PRIMARY KEY ([type],
+[media_id]), FOREIGN KEY([media_id]) REFERENCES [movie]([id]), FOREIGN
 KEY([media_id]) REFERENCES [episode]([id]) )
 
 CREATE TABLE [episode] ( [type] TEXT DEFAULT 'episode', [id] INTEGER
@@ -14,9 +14,9 @@ PRIMARY KEY NOT NULL, [title] TEXT NOT NULL, [year] INTEGER,
 [trakt_id] INTEGER NOT NULL, [trakt_slug] INTEGER, [imdb_id] TEXT,
 [tmdb_id] INTEGER )
 
-CREATE TABLE [ratings] ( [id] TEXT PRIMARY KEY NOT NULL, [type] TEXT,
-[media_id] INTEGER NOT NULL, [rating] INTEGER NOT NULL, [rated_at]
-TEXT, FOREIGN KEY([media_id]) REFERENCES [movie]([id]), FOREIGN
+CREATE TABLE [ratings] ( [type] TEXT NOT NULL, [media_id] INTEGER NOT
+NULL, [rating] INTEGER NOT NULL, [rated_at] TEXT, [removed_at] TEXT, PRIMARY KEY ([type],
+[media_id]), FOREIGN KEY([media_id]) REFERENCES [movie]([id]), FOREIGN
 KEY([media_id]) REFERENCES [episode]([id]), FOREIGN KEY([media_id])
 REFERENCES [show]([id]) )
 
@@ -27,10 +27,28 @@ TEXT, [tmdb_id] INTEGER, [tvrage_id] INTEGER )
 
 CREATE TABLE [watchlist] ( [id] INTEGER PRIMARY KEY NOT NULL, [type]
 TEXT, [media_id] INTEGER NOT NULL, [watchlisted_at] TEXT NOT NULL,
-FOREIGN KEY([media_id]) REFERENCES [movie]([id]), FOREIGN
+[removed_at] TEXT, FOREIGN KEY([media_id]) REFERENCES [movie]([id]), FOREIGN
 KEY([media_id]) REFERENCES [show]([id]) )
 
 CREATE TABLE [watchlog] ( [id] INTEGER PRIMARY KEY NOT NULL, [type]
 TEXT, [media_id] INTEGER NOT NULL, [watched_at] TEXT NOT NULL, FOREIGN
 KEY([media_id]) REFERENCES [movie]([id]), FOREIGN KEY([media_id])
-REFERENCES [episode]([id]) )
\ No newline at end of file
+REFERENCES [episode]([id]) )
+
+CREATE TABLE [media_plays] ( [type] TEXT NOT NULL, [media_id] INTEGER
+NOT NULL, [plays] INTEGER NOT NULL, [first_watched_at] TEXT,
+[last_watched_at] TEXT, PRIMARY KEY ([type], [media_id]) )
+
+CREATE TABLE [daily_plays] ( [day] TEXT NOT NULL, [type] TEXT NOT NULL,
+[plays] INTEGER NOT NULL, PRIMARY KEY ([day], [type]) )
+
+CREATE TABLE [monthly_plays] ( [month] TEXT NOT NULL, [type] TEXT NOT
+NULL, [plays] INTEGER NOT NULL, PRIMARY KEY ([month], [type]) )
+
+CREATE TABLE [show_progress] ( [show_id] INTEGER PRIMARY KEY NOT NULL,
+[watched_episodes] INTEGER NOT NULL, [plays] INTEGER NOT NULL,
+[aired_episodes] INTEGER, [last_watched_at] TEXT )
+
+CREATE TABLE [genre_time] ( [genre_id] TEXT NOT NULL, [type] TEXT NOT
+NULL, [plays] INTEGER NOT NULL, [minutes] INTEGER NOT NULL, PRIMARY KEY
+([genre_id], [type]) )
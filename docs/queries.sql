@@ -6,3 +6,18 @@
 
 -- Cleaner Episode watchlog.
 SELECT S.title as show, S.year, E.season, E.number as episode, E.title, date(watched_at) as date, time(watched_at) as time FROM watchlog W INNER JOIN episode E on E.id == W.media_id INNER JOIN show S on S.id == E.show_id order by watched_at DESC;
+
+-- Daily watch counts, on a database created with --epoch.
+SELECT date(watched_at_ms / 86400000 * 86400, 'unixepoch') as date, count(*) as watched FROM watchlog GROUP BY watched_at_ms / 86400000 order by date DESC;
+
+-- Episode watch counts, precomputed.
+SELECT E.season, E.number, E.title, S.title, P.media_id, P.plays AS watched FROM media_plays P INNER JOIN episode E on E.id == P.media_id INNER JOIN show S on S.id == E.show_id WHERE P.type = 'episode' order by watched DESC;
+
+-- Show progress, precomputed.
+SELECT S.title, P.watched_episodes, P.aired_episodes, P.plays, P.last_watched_at FROM show_progress P INNER JOIN show S on S.id == P.show_id order by P.last_watched_at DESC;
+
+-- Hours watched per genre, precomputed.
+SELECT G.name, sum(T.minutes) / 60 as hours FROM genre_time T INNER JOIN genre G on G.slug == T.genre_id GROUP BY G.name order by hours DESC;
+
+-- Full-text search of the extended episodes, best matches first. Datastore.search() does the same over shows, movies and episodes.
+SELECT X.id, X.title, X.overview FROM extended_episode_fts F INNER JOIN extended_episode X on X.id == F.rowid WHERE extended_episode_fts MATCH 'space' order by F.rank LIMIT 20;
@@ -1,21 +1,79 @@
-import json
 import os
 import time
-from typing import Any
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Generator
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+import codec
+from cache import ResponseCache
+from decode import RowDecoder, Rows
+from ratelimit import RateLimiter
 from trakt import EpisodeSearch, Genre, Season
 
 HOST = "https://api.trakt.tv"
 USER_AGENT = "trakt-to-sqlite"
 CLIENT_ID = os.environ["TRAKT_API_CLIENT_ID"]
-MAXSIZE = 100000
-WAIT_TIME = 1  # second
+PAGE_SIZE = 1000  # items per page of the paginated user endpoints.
+MAX_WORKERS = 4  # concurrent requests during backup.
+RETRIES = 5
+BACKOFF_FACTOR = 1  # second, doubled on every retry.
+RETRY_STATUSES = [500, 502, 503, 504]  # 429s are handled by the rate limiter.
+
+# (item, endpoint) pairs backed up from `users/{username}/{item}/{endpoint}`.
+BACKUP_ENDPOINTS = [
+    ("watched", "movies"),
+    ("watched", "episodes"),
+    ("watched", "shows"),
+    ("ratings", "movies"),
+    ("ratings", "episodes"),
+    ("ratings", "shows"),
+    ("ratings", "seasons"),
+    ("history", "movies"),
+    ("history", "episodes"),
+    ("watchlist", "movies"),
+    ("watchlist", "shows"),
+    ("collection", "movies"),
+    ("collection", "episodes"),
+    ("collection", "shows"),
+    ("stats", ""),
+]
+# Items whose endpoints accept `start_at`, and can be synced incrementally.
+INCREMENTAL_ITEMS = ["history"]
+
+
+def make_session(pool_size: int = MAX_WORKERS) -> requests.Session:
+    """
+    Create a keep-alive session with a connection pool of `pool_size`, that retries
+    5xx responses with exponential backoff, honouring `Retry-After`.
+    """
+    retry = Retry(
+        total=RETRIES,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=["GET"],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
 
 class TraktRequest:
-    def __init__(self, username: str, backup_path: str, api_key: str = CLIENT_ID):
+    def __init__(
+        self,
+        username: str,
+        backup_path: str,
+        api_key: str = CLIENT_ID,
+        session: requests.Session | None = None,
+        limiter: RateLimiter | None = None,
+        cache: ResponseCache | None = None,
+    ):
         self.username = username
         self.backup_url = f"{HOST}/users/{self.username}"
         self.backup_path = backup_path
@@ -25,14 +83,46 @@ class TraktRequest:
             "trakt-api-key": api_key,
             "user-agent": USER_AGENT,
         }
+        self.session = session or make_session()
+        self.limiter = limiter or RateLimiter()
+        self.cache = cache
+
+    def get(self, URL: str, headers: dict[str, str] | None = None) -> requests.Response:
+        """
+        Every request to trakt goes through here, reusing the pooled connections of `session`.
+        Requests are paced by `limiter`, and retried when trakt answers with a 429.
+        """
+        headers = {**self.headers, **headers} if headers else self.headers
+        for _ in range(RETRIES + 1):
+            self.limiter.acquire()
+            response = self.session.get(URL, headers=headers)
+            self.limiter.update(response)
+            if response.status_code != 429:
+                break
+        return response
 
     def get_resource(self, URL: str) -> Any:
-        print(f"Fetching : {URL}")
-        r = requests.get(URL, headers=self.headers)
+        """
+        Fetch a catalog resource, going through `cache` when there is one.
+        """
+        body, headers = None, None
+        if self.cache and self.cache.ttl(URL) is not None:
+            body, etag, fresh = self.cache.lookup(URL)
+            if fresh:
+                return codec.loads(body)  # type: ignore
+            if etag:
+                headers = {"If-None-Match": etag}
 
-        if r.status_code == 200:
-            data = r.content.decode()
-            return json.loads(data)
+        print(f"Fetching : {URL}")
+        r = self.get(URL, headers)
+
+        if r.status_code == 304 and body is not None:
+            self.cache.revalidated(URL)  # type: ignore
+            return codec.loads(body)
+        elif r.status_code == 200:
+            if self.cache and self.cache.ttl(URL) is not None:
+                self.cache.store(URL, r.content, r.headers.get("ETag"))
+            return codec.loads(r.content)
         else:
             raise Exception(
                 f"An error as occurred with code: {r.status_code} while fetching {URL}."
@@ -46,6 +136,13 @@ class TraktRequest:
         URL = f"{HOST}/shows/{show_id}/seasons?extended=episodes"
         return self.get_resource(URL)
 
+    def get_extended_season_data(self, show_slug: str) -> list[Season]:
+        """
+        Fetch every season of a show from Trakt, with the extended data of all their episodes.
+        """
+        URL = f"{HOST}/shows/{show_slug}/seasons?extended=full,episodes"
+        return self.get_resource(URL)
+
     def get_extended_show_data(self, show_slug: str):
         URL = f"{HOST}/shows/{show_slug}?extended=full"
         return self.get_resource(URL)
@@ -70,29 +167,94 @@ class TraktRequest:
         show_genres: list[Genre] = self.get_resource(url)
         return [*movie_genres, *show_genres]
 
-    def fetch(self, item: str, endpoint: str):
-        print(f"Fetching : {self.backup_url}/{item}/{endpoint}")
-        response = requests.get(
-            f"{self.backup_url}/{item}/{endpoint}?limit={MAXSIZE}", headers=self.headers
-        )
-
-        if response.status_code == 404:
-            raise Exception(f"Error: user {self.username} not found")
-        elif response.status_code != 200:
-            print(
-                f"An error as occurred with code: {response.status_code} for operation"
-                f" {item}/{endpoint}"
-            )
+    def iter_raw_pages(
+        self, item: str, endpoint: str, start_at: str | None = None
+    ) -> Generator[bytes, None, None]:
+        """
+        Yield the raw json of `users/{username}/{item}/{endpoint}` one page at a time, following the
+        `X-Pagination-*` headers. Endpoints that are not paginated come back as a single page.
+        `start_at` restricts the endpoints in `INCREMENTAL_ITEMS` to entries from then onwards.
+        """
+        page, page_count = 1, 1
+        while page <= page_count:
+            URL = f"{self.backup_url}/{item}/{endpoint}?page={page}&limit={PAGE_SIZE}"
+            if start_at:
+                URL += f"&start_at={start_at}"
+            print(f"Fetching : {URL}")
+            response = self.get(URL)
+
+            if response.status_code == 404:
+                raise Exception(f"Error: user {self.username} not found")
+            elif response.status_code != 200:
+                raise Exception(
+                    f"An error as occurred with code: {response.status_code} for operation"
+                    f" {item}/{endpoint}"
+                )
+
+            page_count = int(response.headers.get("X-Pagination-Page-Count", page))
+            yield response.content
+            page += 1
+
+    def iter_pages(
+        self, item: str, endpoint: str, start_at: str | None = None
+    ) -> Generator[Any, None, None]:
+        for content in self.iter_raw_pages(item, endpoint, start_at):
+            yield codec.loads(content)
+
+    def iter_entries(
+        self, item: str, endpoint: str, start_at: str | None = None, archive: bool = False
+    ) -> Generator[Any, None, None]:
+        """
+        Yield the entries of `users/{username}/{item}/{endpoint}` one at a time.
+        With `archive`, every entry is also written to `{item}_{endpoint}.jsonl` in `backup_path`,
+        one entry per line, as soon as its page arrives.
+        """
+        fh = None
+        if archive:
+            out_file_path = os.path.join(self.backup_path, f"{item}_{endpoint}.jsonl")
+            print(f"Writing to : {out_file_path}")
+            fh = open(out_file_path, "wb")
+        try:
+            for page in self.iter_pages(item, endpoint, start_at):
+                entries = page if isinstance(page, list) else [page]
+                for entry in entries:
+                    if fh:
+                        fh.write(codec.dumps(entry))
+                        fh.write(b"\n")
+                    yield entry
+        finally:
+            if fh:
+                fh.close()
+
+    def iter_rows(
+        self,
+        item: str,
+        endpoint: str,
+        decoder: RowDecoder[Rows],
+        start_at: str | None = None,
+        archive: bool = False,
+    ) -> Generator[Rows, None, None]:
+        """
+        Yield the rows of every entry of a paginated endpoint, decoded by `decoder` straight from
+        the raw pages. With `archive`, the entries go through `iter_entries` to be written out.
+        """
+        if archive:
+            yield from map(decoder.from_entry, self.iter_entries(item, endpoint, start_at, True))
             return
+        for content in self.iter_raw_pages(item, endpoint, start_at):
+            yield from decoder.decode_page(content)
 
-        if not response.json():
+    def fetch(self, item: str, endpoint: str, start_at: str | None = None):
+        """
+        Stream `users/{username}/{item}/{endpoint}` to `{item}_{endpoint}.jsonl` in `backup_path`.
+        The file is kept when the endpoint is empty, it tells the ingestion that the endpoint was
+        read, so that the items removed since the last backup get tombstoned.
+        """
+        count = sum(1 for _ in self.iter_entries(item, endpoint, start_at, archive=True))
+
+        if not count:
             print(f"No {endpoint} found in {item}")
             return
-
-        out_file_path = os.path.join(self.backup_path, f"{item}_{endpoint}.json")
-        print(f"Writing to : {out_file_path}")
-        with open(out_file_path, "w") as fh:
-            fh.write(json.dumps(response.json(), separators=(",", ":"), indent=4))
         print(f"Completed : {self.backup_url}/{item}/{endpoint}")
 
     def get_watched_movies(self):
@@ -140,30 +302,30 @@ class TraktRequest:
     def get_user_stats(self):
         self.fetch("stats", "")
 
-    def backup(self):
+    def backup(self, workers: int = MAX_WORKERS, watermarks: dict[str, str] | None = None):
+        """
+        Fetch every endpoint in `BACKUP_ENDPOINTS`, `workers` of them at a time.
+        Each endpoint is written to its own `{item}_{endpoint}.jsonl` file in `backup_path`.
+        `watermarks` maps `{item}/{endpoint}` to the latest timestamp already in the db,
+        the endpoints in `INCREMENTAL_ITEMS` are then only fetched from that point onwards.
+        """
         print(f"Starting backup for user : {self.username}")
         start = time.time()
-        self.get_watched_movies()
-        self.get_watched_episodes()
-        self.get_watched_shows()
-        self.get_movies_ratings()
-        self.get_episodes_ratings()
-        self.get_shows_ratings()
-        self.get_seasons_ratings()
-        self.get_movies_history()
-        self.get_episodes_ratings()
-        self.get_movies_watchlist()
-        self.get_episodes_history()
-        self.get_shows_watchlist()
-        self.get_movies_collection()
-        self.get_episodes_collection()
-        self.get_shows_collection()
-        self.get_user_stats()
+        watermarks = watermarks or {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    self.fetch,
+                    item,
+                    endpoint,
+                    watermarks.get(f"{item}/{endpoint}") if item in INCREMENTAL_ITEMS else None,
+                )
+                for item, endpoint in BACKUP_ENDPOINTS
+            ]
+            for future in as_completed(futures):
+                future.result()
         print(f"Completed all operations in {round(time.time() - start, 2)} seconds.")
 
     def test_connection(self) -> bool:
-        response = requests.get(f"{self.backup_url}/stats", headers=self.headers)
+        response = self.get(f"{self.backup_url}/stats")
         return response.status_code == 200
-
-    def wait(self, WAIT_TIME: int = WAIT_TIME):
-        time.sleep(WAIT_TIME)
@@ -0,0 +1,120 @@
+import sqlite3
+import threading
+import time
+from typing import Optional
+from urllib.parse import urlparse
+
+DAY = 24 * 60 * 60  # seconds
+CACHE_SIZE = 512 * 1024 * 1024  # bytes
+# Seconds a cached response is served without asking trakt, by path prefix.
+# URLs matching none of these are not cached.
+CACHE_TTLS = {
+    "/genres/": 30 * DAY,
+    "/movies/": 7 * DAY,
+    "/shows/": 1 * DAY,  # seasons gain new episodes.
+}
+
+
+class ResponseCache:
+    """
+    Persistent cache of trakt responses keyed by URL, in its own sqlite file so it can be
+    shared by every user backed up on the machine.
+    Fresh entries are served as is, stale ones are revalidated with their `ETag`.
+    The least recently used entries are evicted once the bodies exceed `max_size` bytes.
+    """
+
+    def __init__(
+        self, path: str, max_size: int = CACHE_SIZE, ttls: dict[str, int] = CACHE_TTLS
+    ) -> None:
+        self.lock = threading.Lock()
+        self.max_size = max_size
+        self.ttls = ttls
+        self.hits = self.misses = self.revalidations = self.evictions = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA busy_timeout=30000")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS response (url TEXT PRIMARY KEY, body BLOB NOT NULL,"
+            " etag TEXT, size INTEGER NOT NULL, expires_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_response_accessed_at ON response (accessed_at)"
+        )
+        # Size of the bodies, kept up to date by `store` and `evict` rather than summed again.
+        self.size: int = self.conn.execute(
+            "SELECT coalesce(sum(size), 0) FROM response"
+        ).fetchone()[0]
+
+    def ttl(self, URL: str) -> Optional[int]:
+        path = urlparse(URL).path
+        for prefix, ttl in self.ttls.items():
+            if path.startswith(prefix):
+                return ttl
+        return None
+
+    def lookup(self, URL: str) -> tuple[Optional[bytes], Optional[str], bool]:
+        """
+        (body, etag, fresh) of the cached response for `URL`, body is None on a miss.
+        """
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT body, etag, expires_at FROM response WHERE url = ?", [URL]
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None, None, False
+            self.conn.execute("UPDATE response SET accessed_at = ? WHERE url = ?", [now, URL])
+            body, etag, expires_at = row
+            fresh = expires_at > now
+            if fresh:
+                self.hits += 1
+            return body, etag, fresh
+
+    def store(self, URL: str, body: bytes, etag: Optional[str]) -> None:
+        ttl = self.ttl(URL) or 0
+        now = time.time()
+        with self.lock:
+            replaced = self.conn.execute(
+                "SELECT size FROM response WHERE url = ?", [URL]
+            ).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?, ?, ?)",
+                [URL, body, etag, len(body), now + ttl, now],
+            )
+            self.size += len(body) - (replaced[0] if replaced else 0)
+            if self.size > self.max_size:
+                self.evict()
+
+    def revalidated(self, URL: str) -> None:
+        """
+        Trakt answered 304 Not Modified, the cached response is good for another ttl.
+        """
+        ttl = self.ttl(URL) or 0
+        with self.lock:
+            self.revalidations += 1
+            self.conn.execute(
+                "UPDATE response SET expires_at = ? WHERE url = ?", [time.time() + ttl, URL]
+            )
+
+    def evict(self) -> None:
+        # Callers hold the lock. Reads the least recently used entries till enough are found.
+        cursor = self.conn.execute("SELECT url, size FROM response ORDER BY accessed_at")
+        evicted = []
+        for url, size in cursor:
+            if self.size <= self.max_size:
+                break
+            evicted.append((url,))
+            self.size -= size
+        cursor.close()
+        self.conn.executemany("DELETE FROM response WHERE url = ?", evicted)
+        self.evictions += len(evicted)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidations": self.revalidations,
+            "evictions": self.evictions,
+        }
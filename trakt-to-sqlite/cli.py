@@ -1,27 +1,222 @@
 import argparse
+import contextlib
 import logging
 import os
+import shutil
+import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from typing import Any
 
+import requests
 from sqlite_utils import Database
 
-from api import TraktRequest
+from api import MAX_WORKERS, TraktRequest, make_session
+from cache import ResponseCache
 from core import (
     save_collections_files,
     save_history_files,
     save_ratings_files,
     save_watchlist_files,
+    stream_to_db,
 )
-from sql_helpers import Datastore
+from parse import Commons, Extended
+from ratelimit import RateLimiter
+from sql_helpers import BATCH_SIZE, Changes, Datastore, format_changes, merge_changes
 
 logging.basicConfig()
+logger = logging.getLogger("cli")
+logger.setLevel(logging.INFO)
+
+PARALLEL_USERS = 4  # users backed up concurrently in batch mode.
+# Serializes the table checks and migrations, that several users can run on the same catalog.
+SETUP_LOCK = threading.Lock()
+
+
+def read_usernames(file_path: str) -> list[str]:
+    """
+    One username per line, blank lines and lines starting with `#` are skipped.
+    """
+    with open(file_path, encoding="utf-8") as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith("#")]
+
+
+def user_db_path(backup_dir: str, username: str) -> str:
+    return os.path.join(backup_dir, f"backup\\{username}\\{username}.db")
+
+
+def enrich(db: Database, api: TraktRequest, args: argparse.Namespace):
+    logger.info("Writing extended data to db.")
+    logger.info(Commons().generate_genres(db, api))
+    ext = Extended(db, api, workers=args.workers, batch_size=args.batch_size)
+    ext.handle_extended_show()
+    ext.handle_extended_movie()
+    ext.handle_extended_episode_by_season()
+
+
+def backup_user(
+    username: str,
+    args: argparse.Namespace,
+    session: requests.Session,
+    limiter: RateLimiter,
+    cache: ResponseCache | None,
+) -> int:
+    """
+    Backs up a single user, as configured by the cli `args`, and returns the number of
+    watchlog rows in their db.
+    """
+    backup_dir = args.path
+    resume_db_ingestion, keep_downloaded_files, ingestion_into_db = (
+        args.resume,
+        args.keep,
+        args.nodb,
+    )
+
+    db_exists = False
+    timestamp = datetime.fromtimestamp(time.time()).strftime("%Y%m%d%H%M%S")
+    backup_sub_dir = f"backup\\{username}\\{timestamp}"
+    backup_path = os.path.join(backup_dir, backup_sub_dir)
+    os.makedirs(backup_path, exist_ok=True)
+
+    db_path = user_db_path(backup_dir, username)
+    logger.info(f"Backup path : {backup_path}, Database path : {db_path}.")
+    if os.path.isfile(db_path):
+        db_exists = True
+
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+
+    db: Database = Database(db_path)
+
+    with SETUP_LOCK:
+        # Migrate the tables as they are on disk, before any of them moves to the catalog.
+        Datastore(db).migrate_natural_keys()
+        catalog = None
+        if args.catalog:
+            os.makedirs(os.path.dirname(os.path.abspath(args.catalog)), exist_ok=True)
+            catalog = Database(args.catalog)
+        ds = Datastore(db, catalog, epoch=args.epoch)
+        # The catalog too, the tables moved into it have to match its keys.
+        ds.migrate_natural_keys()
+        if catalog and db_exists:
+            logger.info(f"Moving catalog tables into the catalog : {args.catalog}.")
+            ds.migrate_to_catalog()
+        ds.migrate_epoch_timestamps()
+        if not ds.assert_tables():
+            logger.info("All required tables not present. Creating tables.")
+            ds.create_tables()
+        ds.ensure_columns()
+        ds.ensure_indexes()
+        ds.ensure_triggers()
+        ds.ensure_search()
+
+    api = TraktRequest(
+        username, backup_path=backup_path, session=session, limiter=limiter, cache=cache
+    )
+    api.test_connection()
+
+    watermarks = ds.get_watermarks() if args.incremental else None
+    batch_size = args.batch_size
+    stage = ds.bulk_ingest if args.bulk else contextlib.nullcontext
+    changes: Changes = {}
+    if args.stream:
+        logger.info("Streaming user data from trakt API into the db.")
+        with stage():
+            changes = stream_to_db(
+                db,
+                api,
+                archive=keep_downloaded_files,
+                watermarks=watermarks,
+                batch_size=batch_size,
+                catalog=ds.catalog,
+                workers=args.workers,
+            )
+        ds.update_watermarks()
+    else:
+        if not resume_db_ingestion:
+            logger.info("Polling trakt API to backup user data.")
+            api.backup(workers=args.workers, watermarks=watermarks)
+
+        if not ingestion_into_db:
+            # Actual saving to sqlite part.
+            logger.info("Writing Watchlog to db.")
+            with stage():
+                history = save_history_files(db, backup_path, batch_size, ds.catalog)
+            logger.info("Writing Collections to db.")
+            with stage():
+                collections = save_collections_files(
+                    db, backup_path, api, batch_size, ds.catalog, args.workers
+                )
+            logger.info("Writing Ratings to db.")
+            with stage():
+                ratings = save_ratings_files(db, backup_path, batch_size)
+            logger.info("Writing Watchlist to db.")
+            with stage():
+                watchlist = save_watchlist_files(db, backup_path, batch_size, ds.catalog)
+            changes = merge_changes(history, collections, ratings, watchlist)
+            ds.update_watermarks()
+    if changes:
+        logger.info(f"Changes applied for {username} :\n{format_changes(changes)}")
+    if args.extended and not args.catalog:
+        enrich(db, api, args)
+    ds.refresh_aggregates()
+    if not keep_downloaded_files:
+        logger.info(f"Deleting all downloaded json files from : {backup_path}")
+        shutil.rmtree(backup_path)
+    return db["watchlog"].count  # type: ignore
+
+
+def run_backups(
+    usernames: list[str],
+    args: argparse.Namespace,
+    parallel: int,
+    session: requests.Session,
+    limiter: RateLimiter,
+    cache: ResponseCache | None,
+) -> list[dict[str, Any]]:
+    """
+    Backs up `parallel` users at a time, a failing user doesn't stop the others.
+    Returns a report per user, in the order of `usernames`.
+    """
+
+    def run(username: str) -> dict[str, Any]:
+        start_time = time.time()
+        report: dict[str, Any] = {"username": username, "status": "ok", "watchlog": None}
+        try:
+            report["watchlog"] = backup_user(username, args, session, limiter, cache)
+        except Exception as e:
+            logger.exception(f"Backup of {username} failed.")
+            report["status"] = "failed"
+            report["error"] = f"{type(e).__name__}: {e}"
+        report["seconds"] = round(time.time() - start_time, 2)
+        return report
+
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        return list(executor.map(run, usernames))
+
+
+def print_report(reports: list[dict[str, Any]]):
+    width = max(len(report["username"]) for report in reports)
+    print("Backup report :")
+    for report in reports:
+        line = f"  {report['username']:<{width}}  {report['status']:<6}  {report['seconds']}s"
+        if report["status"] == "ok":
+            line += f"  {report['watchlog']} watchlog rows"
+        else:
+            line += f"  {report['error']}"
+        print(line)
+    failed = sum(report["status"] != "ok" for report in reports)
+    print(f"{len(reports) - failed} of {len(reports)} users backed up.")
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="trakt-to-sqlite")
     parser.add_argument(
         "username",
-        help="Pass the trakt username, for backing up data.",
+        nargs="*",
+        help="Pass the trakt username, for backing up data. Several users can be passed.",
     )
     parser.add_argument(
         "path",
@@ -50,58 +245,133 @@ if __name__ == "__main__":
         action="store_true",
         help="If backed up files are NOT to be ingested to db, by default they will be ingested.",
     )
+    parser.add_argument(
+        "--incremental",
+        "-i",
+        action="store_true",
+        help="Only fetch the history that is newer than what is already in the db.",
+    )
+    parser.add_argument(
+        "--stream",
+        "-s",
+        action="store_true",
+        help=(
+            "Write the data straight from the api into the db, without backed up files. Files are"
+            " only written alongside if --keep is passed."
+        ),
+    )
+    parser.add_argument(
+        "--bulk",
+        "-b",
+        action="store_true",
+        help=(
+            "Write every ingestion stage in a single transaction, with pragmas tuned for bulk"
+            " inserts."
+        ),
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=BATCH_SIZE,
+        help=(
+            "Number of rows per insert statement, and per batch of rows compared with the db"
+            f" before being written, defaults to {BATCH_SIZE}."
+        ),
+    )
+    parser.add_argument(
+        "--extended",
+        "-e",
+        action="store_true",
+        help="Fetch the extended data of every show, movie and episode in the db.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help=(
+            "Do not use the on-disk cache of show, movie and genre data, shared by every user"
+            " backed up to the same path."
+        ),
+    )
+    parser.add_argument(
+        "--catalog",
+        "-c",
+        help=(
+            "Path of a catalog database, where shows, episodes, movies, genres and their extended"
+            " data are stored once for every user sharing it. Attached to the user's database."
+        ),
+    )
+    parser.add_argument(
+        "--epoch",
+        action="store_true",
+        help=(
+            "Store watched, collected, rated and watchlisted times as integer epoch milliseconds,"
+            " with the ISO text generated from them. Existing tables are converted."
+        ),
+    )
+    parser.add_argument(
+        "--users-file",
+        "-u",
+        help="File with usernames to back up, one per line, in addition to the ones passed.",
+    )
+    parser.add_argument(
+        "--parallel",
+        "-p",
+        type=int,
+        default=PARALLEL_USERS,
+        help=(
+            f"Number of users backed up concurrently, defaults to {PARALLEL_USERS}. They all share"
+            " the api rate limit."
+        ),
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=MAX_WORKERS,
+        help=(
+            "Number of requests made concurrently during backup and enrichment, defaults to"
+            f" {MAX_WORKERS}."
+        ),
+    )
 
     args = parser.parse_args()
-    logger = logging.getLogger("cli")
-    logger.setLevel(logging.INFO)
     logger.info(args)
-    username, backup_dir = args.username, args.path
-    resume_db_ingestion, keep_downloaded_files, ingestion_into_db = (
-        args.resume,
-        args.keep,
-        args.nodb,
-    )
+    usernames = list(args.username)
+    if args.users_file:
+        usernames += read_usernames(args.users_file)
+    if not usernames:
+        parser.error("pass at least one username, or --users-file.")
+    usernames = list(dict.fromkeys(usernames))
+    backup_dir = args.path
 
-    db_exists = False
     start_time = time.time()
-    timestamp = datetime.fromtimestamp(time.time()).strftime("%Y%m%d%H%M%S")
-    backup_sub_dir = f"backup\\{username}\\{timestamp}"
-    backup_path = os.path.join(backup_dir, backup_sub_dir)
-    os.makedirs(backup_path, exist_ok=True)
-
-    db_sub_dir = f"backup\\{username}\\{username}.db"
-    db_path = os.path.join(backup_dir, db_sub_dir)
-    logger.info(f"Backup path : {backup_path}, Database path : {db_path}.")
-    if os.path.isfile(db_path):
-        db_exists = True
-
-    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    parallel = min(args.parallel, len(usernames))
+    # One session and one rate budget for every user, trakt limits calls per application.
+    session = make_session(args.workers * parallel)
+    limiter = RateLimiter()
+    cache = None
+    if not args.no_cache:
+        cache_sub_dir = "backup\\cache.db"
+        cache_path = os.path.join(backup_dir, cache_sub_dir)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        cache = ResponseCache(cache_path)
 
-    db: Database = Database(db_path)
-
-    ds = Datastore(db)
-    if not ds.assert_tables():
-        logger.info("All required tables not present. Creating tables.")
-        ds.create_tables()
-
-    api = TraktRequest(username, backup_path=backup_path)
-    api.test_connection()
-    if not resume_db_ingestion:
-        logger.info("Polling trakt API to backup user data.")
-        api.backup()
-
-    if not ingestion_into_db:
-        # Actual saving to sqlite part.
-        logger.info("Writing Watchlog to db.")
-        save_history_files(db, backup_path)
-        logger.info("Writing Collections to db.")
-        save_collections_files(db, backup_path, api)
-        logger.info("Writing Ratings to db.")
-        save_ratings_files(db, backup_path)
-        logger.info("Writing Watchlist to db.")
-        save_watchlist_files(db, backup_path)
-    if not keep_downloaded_files:
-        logger.info(f"Deleting all downloaded json files from : {backup_path}")
-        os.rmdir(backup_path)
+    reports = run_backups(usernames, args, parallel, session, limiter, cache)
+    if args.extended and args.catalog:
+        # Users share the catalog, so its extended data is fetched once, after all of them.
+        api = TraktRequest(
+            usernames[0], backup_path=backup_dir, session=session, limiter=limiter, cache=cache
+        )
+        enrich(Database(args.catalog), api, args)
+        for report in reports:
+            if report["status"] == "ok":
+                db = Database(user_db_path(backup_dir, report["username"]))
+                Datastore(db, Database(args.catalog)).refresh_aggregates()
+    if cache:
+        logger.info(f"Response cache : {cache.stats()}")
+    if len(reports) > 1:
+        print_report(reports)
     end_time = time.time()
     print(f"Operation finished in {round(end_time - start_time, 2)} seconds.")
+    if any(report["status"] != "ok" for report in reports):
+        sys.exit(1)
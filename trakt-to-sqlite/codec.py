@@ -0,0 +1,59 @@
+"""
+codec.py picks the JSON codec used to decode trakt responses and backed up files, and to
+write the json lines backups. orjson or msgspec are used when installed, the stdlib json
+module otherwise. The `TRAKT_CODEC` environment variable forces one of them.
+"""
+import json
+import os
+from typing import Any, Callable
+
+Loads = Callable[[bytes | str], Any]
+Dumps = Callable[[Any], bytes]
+
+
+def stdlib_codec() -> tuple[Loads, Dumps]:
+    def dumps(obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+    return json.loads, dumps
+
+
+def orjson_codec() -> tuple[Loads, Dumps]:
+    import orjson
+
+    return orjson.loads, orjson.dumps
+
+
+def msgspec_codec() -> tuple[Loads, Dumps]:
+    import msgspec
+
+    return msgspec.json.decode, msgspec.json.encode
+
+
+# In order of preference, the first one that can be imported is used.
+CODECS: dict[str, Callable[[], tuple[Loads, Dumps]]] = {
+    "orjson": orjson_codec,
+    "msgspec": msgspec_codec,
+    "json": stdlib_codec,
+}
+
+
+def load_codec(name: str | None = None) -> tuple[str, Loads, Dumps]:
+    """
+    Returns the name, decoder and encoder of the codec `name`, or of the first one available.
+    Encoders always produce compact utf-8 bytes.
+    """
+    if name and name not in CODECS:
+        raise ValueError(f"Unknown codec {name}, choose from {', '.join(CODECS)}.")
+    for codec in [name] if name else CODECS:
+        try:
+            loads, dumps = CODECS[codec]()  # type: ignore
+        except ImportError:
+            if name:
+                raise
+            continue
+        return codec, loads, dumps  # type: ignore
+    raise ImportError("No JSON codec available.")
+
+
+NAME, loads, dumps = load_codec(os.environ.get("TRAKT_CODEC"))
@@ -3,15 +3,212 @@ core.py contains the high level functions that will be directly called from the
 and also will be exposed to users for usage.
 """
 import os
+from typing import Any, Iterable
 
 from sqlite_utils import Database
+from sqlite_utils.utils import chunks
 
-from api import TraktRequest
-from parse import Collected, History, Rated, Watchlist
-from support import load_json
+from api import INCREMENTAL_ITEMS, MAX_WORKERS, TraktRequest
+from decode import (EPISODE_COLUMNS, HISTORY_EPISODES, HISTORY_MOVIES, MOVIE_COLUMNS,
+                    SHOW_COLUMNS, WATCHLOG_COLUMNS, Row, RowDecoder, Rows)
+from parse import Collected, Rated, Watchlist
+from sql_helpers import (BATCH_SIZE, CHANGE_KINDS, Changes, ChangeWriter, RowWriter,
+                         merge_changes)
+from support import read_entries, read_rows
 
+FLUSH_SIZE = 10000  # history entries parsed before their rows are written.
 
-def save_ratings_files(db: Database, PATH: str):
+
+def ingest_rated_episodes(
+    db: Database, entries: Iterable[Any], batch_size: int = BATCH_SIZE
+) -> Changes:
+    r = Rated()
+    ratings = ChangeWriter(db, "ratings", tombstones=True, batch_size=batch_size)
+    ratings.apply(map(r.entry_to_rated_episode_row, entries))
+    return {"ratings": ratings.finish("type = ?", ["episode"])}
+
+
+def ingest_rated_shows(
+    db: Database, entries: Iterable[Any], batch_size: int = BATCH_SIZE
+) -> Changes:
+    r = Rated()
+    ratings = ChangeWriter(db, "ratings", tombstones=True, batch_size=batch_size)
+    ratings.apply(map(r.entry_to_rated_show_row, entries))
+    return {"ratings": ratings.finish("type = ?", ["show"])}
+
+
+def ingest_rated_movies(
+    db: Database, entries: Iterable[Any], batch_size: int = BATCH_SIZE
+) -> Changes:
+    r = Rated()
+    ratings = ChangeWriter(db, "ratings", tombstones=True, batch_size=batch_size)
+    ratings.apply(map(r.entry_to_rated_movie_row, entries))
+    return {"ratings": ratings.finish("type = ?", ["movie"])}
+
+
+def ingest_collections(
+    db: Database,
+    api: TraktRequest,
+    episode_entries: Iterable[Any] | None,
+    show_entries: Iterable[Any] | None,
+    movie_entries: Iterable[Any] | None,
+    batch_size: int = BATCH_SIZE,
+    catalog: Database | None = None,
+    workers: int = MAX_WORKERS,
+) -> Changes:
+    """
+    Gets the missing episode data of the collected shows from the api, `workers` shows at a
+    time, and applies the collected episodes and movies to the `collected` table.
+    Shows, episodes and movies go to `catalog`, when it is separate from `db`.
+    Entries that are None weren't read, their part of the collection is left as is. Episodes
+    need the collected shows to be read too.
+    """
+    catalog = catalog or db
+    cl = Collected()
+    changes: Changes = {}
+
+    if episode_entries is not None and show_entries is not None:
+        show_data = list(show_entries)
+        cl.handle_collected_episodes_prerequisites(show_data, catalog, api, batch_size, workers)
+        collected = ChangeWriter(db, "collected", tombstones=True, batch_size=batch_size)
+        collected.apply(map(cl.handle_collected_episode_entry, episode_entries))
+        changes = merge_changes(changes, {"collected": collected.finish("type = ?", ["episode"])})
+
+    if movie_entries is not None:
+        movie_data = list(movie_entries)
+        cl.handle_collected_movies_prerequisites(movie_data, catalog, batch_size)
+        collected = ChangeWriter(db, "collected", tombstones=True, batch_size=batch_size)
+        collected.apply(map(cl.handle_collected_movie_entry, movie_data))
+        changes = merge_changes(changes, {"collected": collected.finish("type = ?", ["movie"])})
+    return changes
+
+
+def ingest_history_episodes(
+    db: Database,
+    rows: Iterable[tuple[Row, Row, Row]],
+    batch_size: int = BATCH_SIZE,
+    catalog: Database | None = None,
+) -> Changes:
+    """
+    Single pass over the episode history, decoded into its watchlog, episode and show rows by
+    `decode.HISTORY_EPISODES`. Shows and episodes are deduplicated in memory, and all the rows
+    are written every `FLUSH_SIZE` entries, the watchlog by a `RowWriter` and the shows and
+    episodes as changes, so that renamed ones get updated. Shows and episodes go to `catalog`,
+    when it is separate from `db`. The tables have to exist already.
+    Shows and episodes are compared with the db `batch_size` at a time, the watchlog rows of a
+    flush go to `executemany` at once.
+    """
+    catalog = catalog or db
+    show_writer = ChangeWriter(catalog, "show", SHOW_COLUMNS, batch_size=batch_size)
+    episode_writer = ChangeWriter(catalog, "episode", EPISODE_COLUMNS, batch_size=batch_size)
+    watchlog_writer = RowWriter(db, "watchlog", WATCHLOG_COLUMNS)
+    watchlog_counts = dict.fromkeys(CHANGE_KINDS, 0)
+    seen_shows: set[int] = set()
+    seen_episodes: set[int] = set()
+    shows: list[Row] = []
+    episodes: list[Row] = []
+    watchlog: list[Row] = []
+
+    def flush():
+        show_writer.apply(shows)
+        episode_writer.apply(episodes)
+        inserted = watchlog_writer.write(watchlog)
+        watchlog_counts["inserted"] += inserted
+        watchlog_counts["unchanged"] += len(watchlog) - inserted
+        shows.clear()
+        episodes.clear()
+        watchlog.clear()
+
+    for watchlog_row, episode_row, show_row in rows:
+        watchlog.append(watchlog_row)
+        if episode_row[1] not in seen_episodes:
+            seen_episodes.add(episode_row[1])
+            episodes.append(episode_row)
+        if show_row[1] not in seen_shows:
+            seen_shows.add(show_row[1])
+            shows.append(show_row)
+        if len(watchlog) >= FLUSH_SIZE:
+            flush()
+    flush()
+    return {
+        "watchlog": watchlog_counts,
+        "show": show_writer.counts,
+        "episode": episode_writer.counts,
+    }
+
+
+def ingest_history_movies(
+    db: Database,
+    rows: Iterable[tuple[Row, Row]],
+    batch_size: int = BATCH_SIZE,
+    catalog: Database | None = None,
+) -> Changes:
+    """
+    Single pass over the movie history, decoded by `decode.HISTORY_MOVIES`,
+    see `ingest_history_episodes`.
+    """
+    catalog = catalog or db
+    movie_writer = ChangeWriter(catalog, "movie", MOVIE_COLUMNS, batch_size=batch_size)
+    watchlog_writer = RowWriter(db, "watchlog", WATCHLOG_COLUMNS)
+    watchlog_counts = dict.fromkeys(CHANGE_KINDS, 0)
+    seen_movies: set[int] = set()
+    movies: list[Row] = []
+    watchlog: list[Row] = []
+
+    def flush():
+        movie_writer.apply(movies)
+        inserted = watchlog_writer.write(watchlog)
+        watchlog_counts["inserted"] += inserted
+        watchlog_counts["unchanged"] += len(watchlog) - inserted
+        movies.clear()
+        watchlog.clear()
+
+    for watchlog_row, movie_row in rows:
+        watchlog.append(watchlog_row)
+        if movie_row[1] not in seen_movies:
+            seen_movies.add(movie_row[1])
+            movies.append(movie_row)
+        if len(watchlog) >= FLUSH_SIZE:
+            flush()
+    flush()
+    return {"watchlog": watchlog_counts, "movie": movie_writer.counts}
+
+
+def ingest_watchlist_shows(
+    db: Database,
+    entries: Iterable[Any],
+    batch_size: int = BATCH_SIZE,
+    catalog: Database | None = None,
+) -> Changes:
+    catalog = catalog or db
+    w = Watchlist()
+    shows = ChangeWriter(catalog, "show", batch_size=batch_size)
+    watchlist = ChangeWriter(db, "watchlist", tombstones=True, batch_size=batch_size)
+    for batch in chunks(entries, batch_size):
+        watchlist_and_shows = list(map(w.handle_watchlist_show_entry, batch))
+        shows.apply(i[1] for i in watchlist_and_shows)
+        watchlist.apply(i[0] for i in watchlist_and_shows)
+    return {"show": shows.counts, "watchlist": watchlist.finish("type = ?", ["show"])}
+
+
+def ingest_watchlist_movies(
+    db: Database,
+    entries: Iterable[Any],
+    batch_size: int = BATCH_SIZE,
+    catalog: Database | None = None,
+) -> Changes:
+    catalog = catalog or db
+    w = Watchlist()
+    movies = ChangeWriter(catalog, "movie", batch_size=batch_size)
+    watchlist = ChangeWriter(db, "watchlist", tombstones=True, batch_size=batch_size)
+    for batch in chunks(entries, batch_size):
+        watchlist_and_movies = list(map(w.handle_watchlist_movie_entry, batch))
+        movies.apply(i[1] for i in watchlist_and_movies)
+        watchlist.apply(i[0] for i in watchlist_and_movies)
+    return {"movie": movies.counts, "watchlist": watchlist.finish("type = ?", ["movie"])}
+
+
+def save_ratings_files(db: Database, PATH: str, batch_size: int = BATCH_SIZE) -> Changes:
     """
     `PATH` should contain all the backed up json files from trakt.
     This method takes that `path`, and a `sqlite connection` to parse the files
@@ -19,32 +216,30 @@ def save_ratings_files(db: Database, PATH: str):
     """
     files = os.listdir(PATH)
     files = list(filter(lambda x: "ratings" in x, files))
-
-    r = Rated()
+    changes: Changes = {}
 
     for file_name in files:
         file_path = os.path.join(PATH, file_name)
         if "episodes" in file_name:
-            data = load_json(file_path)
-            episode_ratings = list(map(r.entry_to_rated_episode_row, data))
-            db["ratings"].insert_all(  # type: ignore
-                episode_ratings, hash_id="id", ignore=True, batch_size=100  # type: ignore
-            )
+            change = ingest_rated_episodes(db, read_entries(file_path), batch_size)
         elif "shows" in file_name:
-            data = load_json(file_path)
-            show_ratings = list(map(r.entry_to_rated_show_row, data))
-            db["ratings"].insert_all(  # type: ignore
-                show_ratings, hash_id="id", ignore=True, batch_size=100  # type: ignore
-            )
+            change = ingest_rated_shows(db, read_entries(file_path), batch_size)
         elif "movies" in file_name:
-            data = load_json(file_path)
-            movie_ratings = list(map(r.entry_to_rated_movie_row, data))
-            db["ratings"].insert_all(  # type: ignore
-                movie_ratings, hash_id="id", ignore=True, batch_size=100  # type: ignore
-            )
+            change = ingest_rated_movies(db, read_entries(file_path), batch_size)
+        else:
+            continue
+        changes = merge_changes(changes, change)
+    return changes
 
 
-def save_collections_files(db: Database, PATH: str, api: TraktRequest):
+def save_collections_files(
+    db: Database,
+    PATH: str,
+    api: TraktRequest,
+    batch_size: int = BATCH_SIZE,
+    catalog: Database | None = None,
+    workers: int = MAX_WORKERS,
+) -> Changes:
     """
     `PATH` should contain all the backed up json files from trakt.
     This method takes that `path`, a `sqlite connection` and an instance of the api class
@@ -54,29 +249,25 @@ def save_collections_files(db: Database, PATH: str, api: TraktRequest):
     files = os.listdir(PATH)
     files = list(filter(lambda x: "collection" in x, files))
 
-    cl = Collected()
-    data = show_data = movie_data = ""
+    data = show_data = movie_data = None
 
     for file_name in files:
         file_path = os.path.join(PATH, file_name)
         if "episodes" in file_name:
-            data = load_json(file_path)
+            data = read_entries(file_path)
         elif "shows" in file_name:
-            show_data = load_json(file_path)
+            show_data = read_entries(file_path)
         elif "movies" in file_name:
-            movie_data = load_json(file_path)
-
-    if data and show_data and movie_data:
-        cl.handle_collected_episodes_prerequisites(show_data, db, api)
-        c_eps = list(map(cl.handle_collected_episode_entry, data))
-        db["collected"].insert_all(c_eps, hash_id="id", ignore=True)  # type: ignore
+            movie_data = read_entries(file_path)
 
-        cl.handle_collected_movies_prerequisites(movie_data, db)
-        movies = list(map(cl.handle_collected_movie_entry, movie_data))
-        db["collected"].insert_all(movies, hash_id="id", ignore=True)  # type: ignore
+    return ingest_collections(
+        db, api, data, show_data, movie_data, batch_size, catalog, workers
+    )
 
 
-def save_history_files(db: Database, PATH: str):
+def save_history_files(
+    db: Database, PATH: str, batch_size: int = BATCH_SIZE, catalog: Database | None = None
+) -> Changes:
     """
     `PATH` should contain all the backed up json files from trakt.
     This method takes that `path`, and a `sqlite connection` to parse the files
@@ -84,37 +275,25 @@ def save_history_files(db: Database, PATH: str):
     """
     files = os.listdir(PATH)
     files = list(filter(lambda x: "history" in x, files))
-
-    h = History()
+    changes: Changes = {}
 
     for file_name in files:
         file_path = os.path.join(PATH, file_name)
         if "episodes" in file_name:
-            episode_data = load_json(file_path)
-            episodes = [i[1] for i in list(map(h.handle_history_episode_entry, episode_data))]
-            watchlog = [i[0] for i in list(map(h.handle_history_episode_entry, episode_data))]
-            shows = [i[2] for i in list(map(h.handle_history_episode_entry, episode_data))]
-
-            db["show"].insert_all(shows, pk="id", ignore=True, batch_size=100)  # type: ignore
-            db["episode"].insert_all(  # type: ignore
-                episodes,
-                pk="id",  # type: ignore
-                ignore=True,  # type: ignore
-                batch_size=100,  # type: ignore
-                foreign_keys=["show_id"],  # type: ignore
-            )
-            db["watchlog"].insert_all(watchlog, ignore=True, batch_size=100)  # type: ignore
-
+            rows = read_rows(file_path, HISTORY_EPISODES)
+            change = ingest_history_episodes(db, rows, batch_size, catalog)
         elif "movies" in file_name:
-            movie_data = load_json(file_path)
-            movies = [i[1] for i in list(map(h.handle_history_movie_entry, movie_data))]
-            watchlog = [i[0] for i in list(map(h.handle_history_movie_entry, movie_data))]
-
-            db["movie"].insert_all(movies, pk="id", ignore=True, batch_size=100)  # type: ignore
-            db["watchlog"].insert_all(watchlog, ignore=True, batch_size=100)  # type: ignore
+            rows = read_rows(file_path, HISTORY_MOVIES)
+            change = ingest_history_movies(db, rows, batch_size, catalog)
+        else:
+            continue
+        changes = merge_changes(changes, change)
+    return changes
 
 
-def save_watchlist_files(db: Database, PATH: str):
+def save_watchlist_files(
+    db: Database, PATH: str, batch_size: int = BATCH_SIZE, catalog: Database | None = None
+) -> Changes:
     """
     `PATH` should contain all the backed up json files from trakt.
     This method takes that `path`, and a `sqlite connection` to parse the files
@@ -122,29 +301,62 @@ def save_watchlist_files(db: Database, PATH: str):
     """
     files = os.listdir(PATH)
     files = list(filter(lambda x: "watchlist" in x, files))
-
-    w = Watchlist()
+    changes: Changes = {}
 
     for file_name in files:
         file_path = os.path.join(PATH, file_name)
         if "shows" in file_name:
-            data = load_json(file_path)
-            watchlist_and_shows = list(map(w.handle_watchlist_show_entry, data))
-            watchlist = [i[0] for i in watchlist_and_shows]
-            shows = [i[1] for i in watchlist_and_shows]
+            change = ingest_watchlist_shows(db, read_entries(file_path), batch_size, catalog)
+        elif "movies" in file_name:
+            change = ingest_watchlist_movies(db, read_entries(file_path), batch_size, catalog)
+        else:
+            continue
+        changes = merge_changes(changes, change)
+    return changes
 
-            db["show"].insert_all(shows, pk="id", ignore=True, batch_size=100)  # type: ignore
-            db["watchlist"].insert_all(  # type: ignore
-                watchlist, pk="id", ignore=True, batch_size=100  # type: ignore
-            )
 
-        elif "movies" in file_name:
-            data = load_json(file_path)
-            watchlist_and_movies = list(map(w.handle_watchlist_movie_entry, data))
-            watchlist = [i[0] for i in watchlist_and_movies]
-            movies = [i[1] for i in watchlist_and_movies]
-
-            db["movie"].insert_all(movies, pk="id", ignore=True, batch_size=100)  # type: ignore
-            db["watchlist"].insert_all(  # type: ignore
-                watchlist, pk="id", ignore=True, batch_size=100  # type: ignore
-            )
+def stream_to_db(
+    db: Database,
+    api: TraktRequest,
+    archive: bool = False,
+    watermarks: dict[str, str] | None = None,
+    batch_size: int = BATCH_SIZE,
+    catalog: Database | None = None,
+    workers: int = MAX_WORKERS,
+) -> Changes:
+    """
+    Feeds the user endpoints straight from the api, page by page, into the same row builders
+    and tables as the `save_*_files` methods, without going through backed up files.
+    With `archive`, the entries are also kept as json lines files in the api's `backup_path`.
+    """
+    watermarks = watermarks or {}
+
+    def entries(item: str, endpoint: str):
+        start_at = watermarks.get(f"{item}/{endpoint}") if item in INCREMENTAL_ITEMS else None
+        return api.iter_entries(item, endpoint, start_at, archive=archive)
+
+    def rows(item: str, endpoint: str, decoder: RowDecoder[Rows]):
+        start_at = watermarks.get(f"{item}/{endpoint}") if item in INCREMENTAL_ITEMS else None
+        return api.iter_rows(item, endpoint, decoder, start_at, archive=archive)
+
+    return merge_changes(
+        ingest_history_episodes(
+            db, rows("history", "episodes", HISTORY_EPISODES), batch_size, catalog
+        ),
+        ingest_history_movies(db, rows("history", "movies", HISTORY_MOVIES), batch_size, catalog),
+        ingest_collections(
+            db,
+            api,
+            entries("collection", "episodes"),
+            entries("collection", "shows"),
+            entries("collection", "movies"),
+            batch_size,
+            catalog,
+            workers,
+        ),
+        ingest_rated_episodes(db, entries("ratings", "episodes"), batch_size),
+        ingest_rated_shows(db, entries("ratings", "shows"), batch_size),
+        ingest_rated_movies(db, entries("ratings", "movies"), batch_size),
+        ingest_watchlist_shows(db, entries("watchlist", "shows"), batch_size, catalog),
+        ingest_watchlist_movies(db, entries("watchlist", "movies"), batch_size, catalog),
+    )
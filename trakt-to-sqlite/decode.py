@@ -0,0 +1,249 @@
+"""
+decode.py turns history entries straight into row tuples, in the column order of their tables.
+With msgspec installed, raw json is decoded into Structs mirroring the schemas of trakt.py,
+that only keep the fields the rows need, without building any intermediate dict.
+Otherwise the entries are decoded by `codec`, and the tuples are read off the dicts.
+"""
+from typing import Any, Callable, Generic, Optional, TypeVar
+
+import codec
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# Column order of the tables, as created by `Datastore`.
+WATCHLOG_COLUMNS = ["id", "type", "media_id", "watched_at"]
+SHOW_COLUMNS = [
+    "type",
+    "id",
+    "title",
+    "year",
+    "trakt_id",
+    "trakt_slug",
+    "tvdb_id",
+    "imdb_id",
+    "tmdb_id",
+    "tvrage_id",
+]
+EPISODE_COLUMNS = [
+    "type",
+    "id",
+    "show_id",
+    "season",
+    "number",
+    "title",
+    "trakt_id",
+    "tvdb_id",
+    "imdb_id",
+    "tmdb_id",
+    "tvrage_id",
+]
+MOVIE_COLUMNS = ["type", "id", "title", "year", "trakt_id", "trakt_slug", "imdb_id", "tmdb_id"]
+
+Row = tuple[Any, ...]
+Rows = TypeVar("Rows")
+
+
+def history_episode_rows(entry: Any) -> tuple[Row, Row, Row]:
+    """
+    watchlog, episode and show rows of a decoded `HistoryEpisode`.
+    """
+    episode, show = entry["episode"], entry["show"]
+    e_ids, s_ids = episode["ids"], show["ids"]
+    show_id = s_ids["trakt"]
+    return (
+        (entry["id"], "episode", e_ids["trakt"], entry["watched_at"]),
+        (
+            "episode",
+            e_ids["trakt"],
+            show_id,
+            episode["season"],
+            episode["number"],
+            episode["title"],
+            e_ids["trakt"],
+            e_ids.get("tvdb"),
+            e_ids.get("imdb"),
+            e_ids.get("tmdb"),
+            e_ids.get("tvrage"),
+        ),
+        (
+            "show",
+            show_id,
+            show["title"],
+            show["year"],
+            show_id,
+            s_ids.get("slug"),
+            s_ids.get("tvdb"),
+            s_ids.get("imdb"),
+            s_ids.get("tmdb"),
+            s_ids.get("tvrage"),
+        ),
+    )
+
+
+def history_movie_rows(entry: Any) -> tuple[Row, Row]:
+    """
+    watchlog and movie rows of a decoded `HistoryMovie`.
+    """
+    movie = entry["movie"]
+    ids = movie["ids"]
+    return (
+        (entry["id"], "movie", ids["trakt"], entry["watched_at"]),
+        (
+            "movie",
+            ids["trakt"],
+            movie["title"],
+            movie["year"],
+            ids["trakt"],
+            ids.get("slug"),
+            ids.get("imdb"),
+            ids.get("tmdb"),
+        ),
+    )
+
+
+class RowDecoder(Generic[Rows]):
+    """
+    Decodes one kind of entry into its rows, from raw json when a msgspec `struct` is given
+    and msgspec is installed, from the dicts of `codec` otherwise.
+    """
+
+    def __init__(
+        self,
+        from_entry: Callable[[Any], Rows],
+        struct: Optional[type] = None,
+        from_struct: Optional[Callable[[Any], Rows]] = None,
+    ) -> None:
+        self.from_entry = from_entry
+        self.entry_decoder = self.page_decoder = None
+        if msgspec and struct and from_struct:
+            self.from_struct = from_struct
+            self.entry_decoder = msgspec.json.Decoder(struct)
+            self.page_decoder = msgspec.json.Decoder(list[struct])  # type: ignore
+
+    def decode(self, data: bytes) -> Rows:
+        """
+        Rows of a single json entry, e.g. a line of a json lines backup.
+        """
+        if self.entry_decoder:
+            return self.from_struct(self.entry_decoder.decode(data))
+        return self.from_entry(codec.loads(data))
+
+    def decode_page(self, data: bytes) -> list[Rows]:
+        """
+        Rows of every entry of a json array, e.g. a page of the api.
+        """
+        if self.page_decoder:
+            return list(map(self.from_struct, self.page_decoder.decode(data)))
+        return list(map(self.from_entry, codec.loads(data)))
+
+
+if msgspec:
+
+    class ShowIDs(msgspec.Struct):
+        trakt: int
+        slug: Optional[str] = None
+        tvdb: Optional[int] = None
+        imdb: Optional[str] = None
+        tmdb: Optional[int] = None
+        tvrage: Optional[int] = None
+
+    class Show(msgspec.Struct):
+        ids: ShowIDs
+        title: Optional[str] = None
+        year: Optional[int] = None
+
+    class EpisodeIDs(msgspec.Struct):
+        trakt: int
+        tvdb: Optional[int] = None
+        imdb: Optional[str] = None
+        tmdb: Optional[int] = None
+        tvrage: Optional[int] = None
+
+    class Episode(msgspec.Struct):
+        ids: EpisodeIDs
+        season: int
+        number: int
+        title: Optional[str] = None
+
+    class MovieIDs(msgspec.Struct):
+        trakt: int
+        slug: Optional[str] = None
+        imdb: Optional[str] = None
+        tmdb: Optional[int] = None
+
+    class Movie(msgspec.Struct):
+        ids: MovieIDs
+        title: Optional[str] = None
+        year: Optional[int] = None
+
+    class HistoryEpisode(msgspec.Struct):
+        id: int
+        watched_at: str
+        episode: Episode
+        show: Show
+
+    class HistoryMovie(msgspec.Struct):
+        id: int
+        watched_at: str
+        movie: Movie
+
+    def history_episode_struct_rows(entry: HistoryEpisode) -> tuple[Row, Row, Row]:
+        episode, show = entry.episode, entry.show
+        e_ids, s_ids = episode.ids, show.ids
+        return (
+            (entry.id, "episode", e_ids.trakt, entry.watched_at),
+            (
+                "episode",
+                e_ids.trakt,
+                s_ids.trakt,
+                episode.season,
+                episode.number,
+                episode.title,
+                e_ids.trakt,
+                e_ids.tvdb,
+                e_ids.imdb,
+                e_ids.tmdb,
+                e_ids.tvrage,
+            ),
+            (
+                "show",
+                s_ids.trakt,
+                show.title,
+                show.year,
+                s_ids.trakt,
+                s_ids.slug,
+                s_ids.tvdb,
+                s_ids.imdb,
+                s_ids.tmdb,
+                s_ids.tvrage,
+            ),
+        )
+
+    def history_movie_struct_rows(entry: HistoryMovie) -> tuple[Row, Row]:
+        movie, ids = entry.movie, entry.movie.ids
+        return (
+            (entry.id, "movie", ids.trakt, entry.watched_at),
+            (
+                "movie",
+                ids.trakt,
+                movie.title,
+                movie.year,
+                ids.trakt,
+                ids.slug,
+                ids.imdb,
+                ids.tmdb,
+            ),
+        )
+
+    HISTORY_EPISODES: RowDecoder[tuple[Row, Row, Row]] = RowDecoder(
+        history_episode_rows, HistoryEpisode, history_episode_struct_rows
+    )
+    HISTORY_MOVIES: RowDecoder[tuple[Row, Row]] = RowDecoder(
+        history_movie_rows, HistoryMovie, history_movie_struct_rows
+    )
+else:
+    HISTORY_EPISODES = RowDecoder(history_episode_rows)
+    HISTORY_MOVIES = RowDecoder(history_movie_rows)
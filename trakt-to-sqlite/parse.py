@@ -1,17 +1,23 @@
-from itertools import repeat
-
-from api import TraktRequest
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from itertools import chain, repeat
+from typing import Any, Callable, Iterable
+
+from api import MAX_WORKERS, TraktRequest
+from sql_helpers import BATCH_SIZE, Datastore
 from sqlite_utils import Database
 from trakt import (CollectedEpisode, CollectedEpisodeRow, CollectedMovie,
                    CollectedMovieRow, CollectedShow, Episode, EpisodeRow,
                    ExtendedEpisode, ExtendedEpisodeRow, ExtendedMovie,
                    ExtendedMovieRow, ExtendedShow, ExtendedShowRow,
-                   HistoryEpisode, HistoryEpisodeRow, HistoryMovie,
-                   HistoryMovieRow, Movie, MovieRow, RatedEpisode,
+                   GenreMappingRow, Movie, MovieRow, RatedEpisode,
                    RatedEpisodeRow, RatedMovie, RatedMovieRow, RatedShow,
                    RatedShowRow, Season, Show, ShowRow, WatchlistMovie,
                    WatchlistMovieRow, WatchlistShow, WatchlistShowRow)
 
+FLUSH_INTERVAL = 60  # seconds between two flushes of enriched rows to the db.
+
 
 class Commons:
     def episode_to_episode_row(self, entry: Episode, show_id: int) -> EpisodeRow:
@@ -72,7 +78,7 @@ class Commons:
 
     def generate_genres(self, db: Database, api: TraktRequest) -> str:
         g = api.get_genre_data()
-        db["genre"].insert_all(g, hash_id="id", batch_size=50, ignore=True)  # type: ignore
+        db["genre"].upsert_all(g, pk="slug", batch_size=50)  # type: ignore
         return f"Added {len(list(db['genre'].rows))} genres to genre table."  # type: ignore
 
     def extended_episode_to_extended_episode_row(
@@ -152,59 +158,9 @@ class Commons:
         }
 
 
-class History:
-    # Parse API Data, history_episodes to sqlite rows.
-    def entry_to_history_episode_row(self, entry: HistoryEpisode) -> HistoryEpisodeRow:
-        return {
-            "id": entry["id"],
-            "type": "episode",
-            "media_id": entry["episode"]["ids"]["trakt"],
-            "watched_at": entry["watched_at"],
-        }
-
-    def entry_to_episode(self, entry: HistoryEpisode) -> Episode:
-        return entry["episode"]
-
-    def entry_to_show(self, entry: HistoryEpisode) -> Show:
-        return entry["show"]
-
-    def get_show_id_from_entry(self, entry: HistoryEpisode) -> int:
-        return entry["show"]["ids"]["trakt"]
-
-    def handle_history_episode_entry(
-        self,
-        entry: HistoryEpisode,
-    ) -> tuple[HistoryEpisodeRow, EpisodeRow, ShowRow]:
-        c = Commons()
-        h_ep_row = self.entry_to_history_episode_row(entry)
-        show_id = self.get_show_id_from_entry(entry)
-        ep_row = c.episode_to_episode_row(self.entry_to_episode(entry), show_id)
-        s_row = c.show_to_show_row(self.entry_to_show(entry))
-        return h_ep_row, ep_row, s_row
-
-    # Parse API Data, history_movies to sqlite rows.
-    def entry_to_history_movie_row(self, entry: HistoryMovie) -> HistoryMovieRow:
-        return {
-            "id": entry["id"],
-            "type": "movie",
-            "media_id": entry["movie"]["ids"]["trakt"],
-            "watched_at": entry["watched_at"],
-        }
-
-    def entry_to_movie(self, entry: HistoryMovie) -> Movie:
-        return entry["movie"]
-
-    def handle_history_movie_entry(
-        self,
-        entry: HistoryMovie,
-    ) -> tuple[HistoryMovieRow, MovieRow]:
-        c = Commons()
-        h_m_row = self.entry_to_history_movie_row(entry)
-        m_row = c.movie_to_movie_row(self.entry_to_movie(entry))
-        return h_m_row, m_row
-
-
 class Collected:
+    commons = Commons()
+
     # Parse API Data, collected_episodes to sqlite rows.
     def entry_to_collected_episode_row(self, entry: CollectedEpisode) -> CollectedEpisodeRow:
         return {
@@ -230,47 +186,81 @@ class Collected:
         return entry["episode"]["ids"]["trakt"]
 
     def entry_to_episode_row(self, entry: Episode, show_id: int) -> EpisodeRow:
-        return Commons().episode_to_episode_row(entry, show_id)
+        return self.commons.episode_to_episode_row(entry, show_id)
+
+    def collected_episode_numbers(self, entry: CollectedShow) -> set[tuple[int, int]]:
+        return {
+            (season["number"], episode["number"])
+            for season in entry.get("seasons", [])
+            for episode in season["episodes"]
+        }
 
     def handle_collected_episodes_prerequisites(
-        self, show_data: list[CollectedShow], db: Database, api: TraktRequest
+        self,
+        show_data: list[CollectedShow],
+        db: Database,
+        api: TraktRequest,
+        batch_size: int = BATCH_SIZE,
+        workers: int = MAX_WORKERS,
     ) -> None:
-        c = Commons()
+        """
+        Writes the collected shows, and all the episodes of the shows whose collected episodes
+        are not all in the db yet. Their seasons are fetched `workers` at a time, and the
+        episodes written as the responses come in.
+        """
+        c = self.commons
 
-        show_ids: list[int] = []
+        collected: dict[int, set[tuple[int, int]]] = {}
         show_rows: list[ShowRow] = []
         for entry in show_data:
             show_id: int = entry["show"]["ids"]["trakt"]
             show: Show = entry["show"]
-            show_ids.append(show_id)
+            collected[show_id] = self.collected_episode_numbers(entry)
             show_rows.append(c.show_to_show_row(show))
 
-        db["show"].insert_all(show_rows, pk="id", batch_size=100, ignore=True)  # type: ignore
-
-        for show_id in show_ids:
+        db["show"].insert_all(  # type: ignore
+            show_rows, pk="id", batch_size=batch_size, ignore=True  # type: ignore
+        )
+
+        stored = Datastore(db).get_episode_numbers_by_show(list(collected))
+        show_ids = [
+            show_id
+            for show_id, numbers in collected.items()
+            if not stored.get(show_id) or not numbers <= stored[show_id]
+        ]
+        print(
+            f"Fetching the seasons of {len(show_ids)} collected shows,"
+            f" {len(collected) - len(show_ids)} already complete."
+        )
+
+        def fetch(show_id: int) -> list[EpisodeRow]:
             seasons = api.get_season_data(show_id)
-            episodes = c.multiple_seasons_to_list_episode_row(seasons, show_id)
+            return c.multiple_seasons_to_list_episode_row(seasons, show_id)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            episodes = chain.from_iterable(executor.map(fetch, show_ids))
             db["episode"].insert_all(  # type: ignore
                 episodes,
                 pk="id",  # type: ignore
                 foreign_keys=["show_id"],  # type: ignore
-                batch_size=100,  # type: ignore
+                batch_size=batch_size,  # type: ignore
                 ignore=True,  # type: ignore
             )
-            api.wait()
 
     def handle_collected_episode_entry(self, entry: CollectedEpisode) -> CollectedEpisodeRow:
         cl_episode_row = self.entry_to_collected_episode_row(entry)
         return cl_episode_row
 
     def handle_collected_movies_prerequisites(
-        self, movie_data: list[CollectedMovie], db: Database
+        self, movie_data: list[CollectedMovie], db: Database, batch_size: int = BATCH_SIZE
     ) -> None:
-        c = Commons()
+        c = self.commons
         movies = list(map(self.entry_to_movie, movie_data))
         movie_rows: list[MovieRow] = list(map(c.movie_to_movie_row, movies))
 
-        db["movie"].insert_all(movie_rows, pk="id", batch_size=100, ignore=True)  # type: ignore
+        db["movie"].insert_all(  # type: ignore
+            movie_rows, pk="id", batch_size=batch_size, ignore=True  # type: ignore
+        )
 
     def handle_collected_movie_entry(self, entry: CollectedMovie) -> CollectedMovieRow:
         cl_movie_row = self.entry_to_collected_movie_row(entry)
@@ -278,6 +268,8 @@ class Collected:
 
 
 class Rated:
+    commons = Commons()
+
     # Parse API Data, rated_episodes to sqlite rows.
     def entry_to_rated_episode_row(self, entry: RatedEpisode) -> RatedEpisodeRow:
         return {
@@ -305,6 +297,8 @@ class Rated:
 
 
 class Watchlist:
+    commons = Commons()
+
     # Parse API Data, watchlist_shows to sqlite rows.
     def entry_to_watchlisted_show_row(self, entry: WatchlistShow) -> WatchlistShowRow:
         return {
@@ -332,7 +326,7 @@ class Watchlist:
         self,
         entry: WatchlistShow,
     ) -> tuple[WatchlistShowRow, ShowRow]:
-        c = Commons()
+        c = self.commons
         show = self.entry_to_show(entry)
         show_row = c.show_to_show_row(show)
         watch_show_row = self.entry_to_watchlisted_show_row(entry)
@@ -342,7 +336,7 @@ class Watchlist:
         self,
         entry: WatchlistMovie,
     ) -> tuple[WatchlistMovieRow, MovieRow]:
-        c = Commons()
+        c = self.commons
         movie = self.entry_to_movie(entry)
         movie_row = c.movie_to_movie_row(movie)
         watch_movie_row = self.entry_to_watchlisted_movie_row(entry)
@@ -350,36 +344,142 @@ class Watchlist:
 
 
 class Extended:
-    def __init__(self, db: Database, api: TraktRequest) -> None:
+    def __init__(
+        self,
+        db: Database,
+        api: TraktRequest,
+        workers: int = MAX_WORKERS,
+        batch_size: int = BATCH_SIZE,
+    ) -> None:
         self.db = db
+        self.ds = Datastore(db)
+        self.commons = Commons()
         self.api = api
+        self.workers = workers
+        self.batch_size = batch_size
 
     def generate_genre_mapping(
         self,
     ) -> dict[str, str]:
         """
         Generate genre_name_to_id mapping.
-        Reads in genre table from db, adds all the {name : id} pairs to a dict.
+        Reads in genre table from db, adds all the {name : slug} pairs to a dict, the slug
+        being the genre's id.
         """
         genre_name_to_id_mapping: dict[str, str] = {}
         for row in self.db["genre"].rows:  # type: ignore
             name: str = row["name"].lower().replace("-", " ")  # type: ignore
-            genre_name_to_id_mapping[name] = row["id"]  # type: ignore
+            genre_name_to_id_mapping[name] = row["slug"]  # type: ignore
 
         return genre_name_to_id_mapping
 
-    def generate_show_id_slug_mapping(
+    def enrich(
         self,
-    ) -> dict[int, str]:
+        table: str,
+        keys: Iterable[Any],
+        fetch: Callable[[Any], tuple[list[Any], list[GenreMappingRow]]],
+        name: str | None = None,
+    ) -> None:
         """
-        Generate show_id : show_slug mapping.
-        Reads in show table from db, adds all the {id : slug} pairs to a dict.
+        Engine shared by the `handle_extended_*` methods.
+        `keys` are handed out to `workers` threads calling `fetch`, which returns the rows for
+        `table` and their genre mappings. The requests share the api's session and rate limiter.
+        This thread is the single writer, flushing the fetched rows into `table` and
+        `genre_mapping` every `batch_size` rows or `FLUSH_INTERVAL` seconds, in a transaction
+        that also records the checkpoint of the enrichment, `name` defaulting to `table`,
+        in the `enrichment_state` table.
+        `keys` must come in ascending order of their first element, the checkpoint being the
+        highest one up to which every key has been written.
+        Stops at the first failed fetch, after writing everything fetched so far.
         """
-        show_id_to_slug_mapping: dict[int, str] = {}
-        for row in self.db["show"].rows:  # type: ignore
-            show_id_to_slug_mapping[row["id"]] = row["trakt_slug"]  # type: ignore
+        name = name or table
+        all_rows: list[Any] = []
+        all_genres: list[GenreMappingRow] = []
+        submitted: deque[int] = deque()  # ids of the keys, in submission order.
+        completed: set[int] = set()
+        checkpoint = None
+        last_flush = time.monotonic()
+        count = 0
+
+        def write():
+            nonlocal checkpoint, last_flush
+            while submitted and submitted[0] in completed:
+                checkpoint = submitted.popleft()
+                completed.remove(checkpoint)
+            with self.db.atomic():
+                self.db[table].insert_all(  # type: ignore
+                    all_rows, pk="id", ignore=True, batch_size=self.batch_size  # type: ignore
+                )
+                self.db["genre_mapping"].insert_all(  # type: ignore
+                    all_genres,
+                    pk=("type", "media_id", "genre_id"),  # type: ignore
+                    ignore=True,  # type: ignore
+                    batch_size=self.batch_size,  # type: ignore
+                )
+                if checkpoint is not None:
+                    self.ds.set_checkpoint(name, checkpoint)
+            all_rows.clear()
+            all_genres.clear()
+            last_flush = time.monotonic()
+
+        def collect(futures: dict[Future[Any], int]):
+            # Keeps the results of every successful fetch, then raises the first failure.
+            nonlocal count
+            error = None
+            for future, id in futures.items():
+                if future.cancelled():
+                    continue
+                if future.exception():
+                    error = error or future.exception()
+                    continue
+                rows, genres = future.result()
+                count += len(rows)
+                all_rows.extend(rows)
+                all_genres.extend(genres)
+                completed.add(id)
+            if len(all_rows) >= self.batch_size or time.monotonic() - last_flush >= FLUSH_INTERVAL:
+                write()
+            if error:
+                raise error
+
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        pending: dict[Future[Any], int] = {}
+        try:
+            for key in keys:
+                submitted.append(key[0])
+                pending[executor.submit(fetch, key)] = key[0]
+                if len(pending) >= 2 * self.workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect({future: pending.pop(future) for future in done})
+            remaining, pending = pending, {}
+            collect(remaining)
+            write()
+            self.ds.clear_checkpoint(name)
+        except Exception as e:
+            print(f"Encountered exception : {e}")
+            executor.shutdown(wait=True, cancel_futures=True)
+            try:
+                collect(pending)
+            except Exception:
+                pass
+            write()
+        finally:
+            executor.shutdown(wait=True)
+            print(f"Finished writing {count} rows into {table} table.")
 
-        return show_id_to_slug_mapping
+    def genre_rows(
+        self,
+        type: str,
+        media_id: int,
+        genres: list[str],
+        genre_name_to_id_mapping: dict[str, str],
+    ) -> list[GenreMappingRow]:
+        rows: list[GenreMappingRow] = []
+        for genre in genres:
+            genre_name = genre.lower().replace("-", " ")
+            genre_id = genre_name_to_id_mapping[genre_name]
+            rows.append({"type": type, "media_id": media_id, "genre_id": genre_id})
+        return rows
 
     def handle_extended_movie(self):
         """
@@ -389,40 +489,21 @@ class Extended:
         extended movie data to the extended_movie table.
         """
         genre_name_to_id_mapping = self.generate_genre_mapping()
-        extended_movie_ids: set[int] = set()
-        all_rows: list[ExtendedMovieRow] = []
-        all_genres: list[dict[str, str | int]] = []
-        count = 0
 
-        for row in self.db["extended_movie"].rows:  # type: ignore
-            extended_movie_ids.add(row["id"])  # type: ignore
-        try:
-            count += 1
-            for row in self.db["movie"].rows:  # type: ignore
-                movie_slug, movie_id = row["trakt_slug"], row["id"]  # type: ignore
-                if movie_id in extended_movie_ids:
-                    print(f"{count}. Skipping {movie_slug}")
-                    continue
-                extended_data = self.api.get_extended_movie_data(movie_slug)  # type: ignore
-                extended_data_row = Commons().extended_movie_to_extended_movie_row(extended_data)
-                genres = extended_data["genres"]
-                movie_id = extended_data_row["id"]
-                for genre in genres:
-                    genre_name = genre.lower().replace("-", " ")
-                    genre_id = genre_name_to_id_mapping[genre_name]
-                    g: dict[str, str | int] = {"media_id": movie_id, "genre_id": genre_id}
-                    all_genres.append(g)
-
-                print(f"{count}. {extended_data_row['title']}")
-                all_rows.append(extended_data_row)
-                self.api.wait(5)
-        except Exception as e:
-            print(f"Encountered exception : {e}")
-        finally:
-            self.db["extended_movie"].insert_all(all_rows, pk="id", batch_size=50)  # type: ignore
-            print(f"Finished writing {len(all_rows)} rows into extended_movie table.")
-            self.db["genre_mapping"].insert_all(all_genres, hash_id="id", ignore=True)  # type: ignore
-            print(f"Finished writing {len(all_genres)} rows into genre_mapping table.")
+        def fetch(key: tuple[int, str]):
+            _, movie_slug = key
+            extended_data = self.api.get_extended_movie_data(movie_slug)
+            extended_data_row = self.commons.extended_movie_to_extended_movie_row(extended_data)
+            genres = self.genre_rows(
+                "movie",
+                extended_data_row["id"],
+                extended_data["genres"],
+                genre_name_to_id_mapping,
+            )
+            print(f"Fetched {extended_data_row['title']}")
+            return [extended_data_row], genres
+
+        self.enrich("extended_movie", self.ds.get_unenriched_movie_keys(), fetch)
 
     def handle_extended_show(self):
         """
@@ -432,82 +513,71 @@ class Extended:
         extended show data to the extended_show table.
         """
         genre_name_to_id_mapping = self.generate_genre_mapping()
-        extended_show_ids: set[int] = set()
-        all_rows: list[ExtendedShowRow] = []
-        all_genres: list[dict[str, str | int]] = []
-        count = 0
 
-        for row in self.db["extended_show"].rows:  # type: ignore
-            extended_show_ids.add(row["id"])  # type: ignore
+        def fetch(key: tuple[int, str]):
+            _, show_slug = key
+            extended_data = self.api.get_extended_show_data(show_slug)
+            extended_data_row = self.commons.extended_show_to_extended_show_row(extended_data)
+            genres = self.genre_rows(
+                "show",
+                extended_data_row["id"],
+                extended_data["genres"],
+                genre_name_to_id_mapping,
+            )
+            print(f"Fetched {extended_data_row['title']}")
+            return [extended_data_row], genres
 
-        try:
-            count += 1
-            for row in self.db["show"].rows:  # type: ignore
-                show_slug, show_id = row["trakt_slug"], row["id"]  # type: ignore
-                if show_id in extended_show_ids:
-                    print(f"{count}. Skipping {show_slug}")
-                    continue
-                extended_data = self.api.get_extended_show_data(show_slug)  # type: ignore
-                extended_data_row = Commons().extended_show_to_extended_show_row(extended_data)
-                genres = extended_data["genres"]
-                show_id = extended_data_row["id"]
-                for genre in genres:
-                    genre_name = genre.lower().replace("-", " ")
-                    genre_id = genre_name_to_id_mapping[genre_name]
-                    g: dict[str, str | int] = {"media_id": show_id, "genre_id": genre_id}
-                    all_genres.append(g)
-
-                print(f"{count}. {extended_data_row['title']}")
-                all_rows.append(extended_data_row)
-                self.api.wait(10)
-        except Exception as e:
-            print(f"Encountered exception : {e}")
-        finally:
-            self.db["extended_show"].insert_all(all_rows, pk="id", ignore=True)  # type: ignore
-            print(f"Finished writing {len(all_rows)} rows into extended_show table.")
-            self.db["genre_mapping"].insert_all(all_genres, hash_id="id", ignore=True)  # type: ignore
-            print(f"Finished writing {len(all_genres)} rows into genre_mapping table.")
+        self.enrich("extended_show", self.ds.get_unenriched_show_keys(), fetch)
 
     def handle_extended_episode(self):
         """
         For every row in the episode table, fetches the extended varsion of the data.
         (Provided it is not already present in the extended_episode table).
-        Adds the genre mappings to the genre_mappings table, adds the
-        extended episode data to the extended_episode table.
+        Adds the extended episode data to the extended_episode table.
         """
-        show_slug_id_mapping = self.generate_show_id_slug_mapping()
-        extended_episode_ids: set[int] = set()
-        all_rows: list[ExtendedEpisodeRow] = []
-        count = 0
 
-        for row in self.db["extended_episode"].rows:  # type: ignore
-            extended_episode_ids.add(row["id"])  # type: ignore
+        def fetch(key: tuple[int, int, str, int, int]):
+            _, show_id, show_slug, ep_season, ep_episode = key
+            extended_data = self.api.get_extended_episode_data(show_slug, ep_season, ep_episode)
+            extended_data_row = self.commons.extended_episode_to_extended_episode_row(
+                extended_data, show_id
+            )
+            print(f"Fetched {show_slug}-S{ep_season}-E{ep_episode}")
+            return [extended_data_row], []
 
-        try:
-            count += 1
-            for row in self.db["episode"].rows:  # type: ignore
-                episode_id, show_id, ep_season, ep_episode = map(
-                    int,
-                    (  # type: ignore
-                        row["id"],
-                        row["show_id"],
-                        row["season"],
-                        row["number"],
-                    ),
-                )
-                show_slug = show_slug_id_mapping[show_id]
-                if episode_id in extended_episode_ids:
-                    print(f"{count}. Skipping {show_slug}-S{ep_season}-E{ep_episode}")
-                    continue
-                extended_data = self.api.get_extended_episode_data(show_slug, ep_season, ep_episode)
-                extended_data_row = Commons().extended_episode_to_extended_episode_row(
-                    extended_data, show_id
+        self.enrich("extended_episode", self.ds.get_unenriched_episode_keys(), fetch)
+
+    def handle_extended_episode_by_season(self):
+        """
+        Same as `handle_extended_episode`, but makes a single request per show, for all its
+        seasons with their extended episodes. Episodes missing from that response are
+        fetched one at a time.
+        """
+
+        def fetch(key: tuple[int, str, list[tuple[int, int, int]]]):
+            show_id, show_slug, pending = key
+            seasons = self.api.get_extended_season_data(show_slug)
+            episodes: dict[int, ExtendedEpisode] = {
+                episode["ids"]["trakt"]: episode  # type: ignore
+                for season in seasons
+                for episode in season.get("episodes", [])
+            }
+            rows: list[ExtendedEpisodeRow] = []
+            for episode_id, ep_season, ep_episode in pending:
+                extended_data = episodes.get(episode_id)
+                if extended_data is None:
+                    extended_data = self.api.get_extended_episode_data(
+                        show_slug, ep_season, ep_episode
+                    )
+                rows.append(
+                    self.commons.extended_episode_to_extended_episode_row(extended_data, show_id)
                 )
-                print(f"{count}. {show_slug}-S{ep_season}-E{ep_episode}")
-                all_rows.append(extended_data_row)
-                self.api.wait(10)
-        except Exception as e:
-            print(f"Encountered exception : {e}")
-        finally:
-            self.db["extended_episode"].insert_all(all_rows, pk="id", ignore=True)  # type: ignore
-            print(f"Finished writing {len(all_rows)} rows into extended_episode table.")
+            print(f"Fetched {len(rows)} episodes of {show_slug}")
+            return rows, []
+
+        self.enrich(
+            "extended_episode",
+            self.ds.get_unenriched_show_episode_keys(),
+            fetch,
+            name="extended_episode_seasons",
+        )
@@ -0,0 +1,65 @@
+import json
+import threading
+import time
+
+import requests
+
+# Trakt allows 1000 GET calls every 5 minutes, per application.
+RATE_LIMIT = 1000
+RATE_PERIOD = 300  # seconds
+RETRY_AFTER = 1  # second, when a 429 comes without a usable `Retry-After`.
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every thread issuing requests to trakt.
+    Refills at `limit / period` tokens per second, and re-syncs itself with the
+    `X-Ratelimit` header and the `Retry-After` of 429 responses.
+    """
+
+    def __init__(self, limit: int = RATE_LIMIT, period: int = RATE_PERIOD) -> None:
+        self.lock = threading.Lock()
+        self.capacity = float(limit)
+        self.rate = limit / period  # tokens per second.
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self) -> None:
+        """
+        Block until a request is allowed to go out.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(delay)
+
+    def update(self, response: requests.Response) -> None:
+        """
+        Adapt the bucket to what trakt reports about the remaining allowance.
+        """
+        header = response.headers.get("X-Ratelimit")
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            if header:
+                info = json.loads(header)
+                self.capacity = float(info["limit"])
+                self.rate = info["limit"] / info["period"]
+                self.tokens = min(self.tokens, float(info["remaining"]))
+            if response.status_code == 429:
+                try:
+                    retry_after = float(response.headers.get("Retry-After", RETRY_AFTER))
+                except ValueError:
+                    retry_after = RETRY_AFTER
+                self.paused_until = max(self.paused_until, now + retry_after)
+                self.tokens = 0
@@ -1,11 +1,269 @@
-from typing import Callable, Generator, Any
+import json
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from itertools import groupby
+from typing import Callable, Generator, Any, Iterable, Optional
 
 from sqlite_utils import Database
+from sqlite_utils.utils import chunks
+
+BATCH_SIZE = 1000  # rows per insert statement.
+# Pragmas applied for the duration of a bulk ingest, on top of WAL journaling.
+BULK_PRAGMAS = {
+    "synchronous": "NORMAL",
+    "cache_size": -64000,  # 64MB
+    "temp_store": "MEMORY",
+}
+BUSY_TIMEOUT = 600000  # ms a connection waits for a lock on the shared catalog.
+# Timestamps that can be stored as INTEGER unix epoch milliseconds, in a `<column>_ms` column,
+# the ISO text column then being generated from it.
+EPOCH_COLUMNS = {
+    "watchlog": "watched_at",
+    "collected": "collected_at",
+    "ratings": "rated_at",
+    "watchlist": "watchlisted_at",
+}
+TO_EPOCH_MS = "CAST(round((julianday({}) - 2440587.5) * 86400000) AS INTEGER)"
+FROM_EPOCH_MS = "strftime('%Y-%m-%dT%H:%M:%fZ', {} / 1000.0, 'unixepoch')"
+
+
+def utc_now() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def epoch_column(db: Database, table: str) -> Optional[str]:
+    """
+    The timestamp of `table` stored as epoch milliseconds, if any.
+    """
+    column = EPOCH_COLUMNS.get(table)
+    if column and f"{column}_ms" in db[table].columns_dict:
+        return column
+    return None
+
+
+def row_columns(db: Database, table: str) -> list[str]:
+    """
+    Columns of the rows of `table`, a timestamp stored as epoch milliseconds by its ISO name.
+    """
+    epoch = epoch_column(db, table)
+    return [epoch if column.name == f"{epoch}_ms" else column.name for column in db[table].columns]
+
+
+def stored_columns(db: Database, table: str, columns: list[str]) -> tuple[list[str], list[str]]:
+    """
+    Stored column and value placeholder of each of `columns`. An ISO timestamp stored as epoch
+    milliseconds goes to its `_ms` column, converted by SQLite.
+    """
+    epoch = epoch_column(db, table)
+    names = [f"{column}_ms" if column == epoch else column for column in columns]
+    values = [TO_EPOCH_MS.format("?") if column == epoch else "?" for column in columns]
+    return names, values
+
+
+class RowWriter:
+    """
+    Writes row tuples to `table` through one prepared `INSERT OR IGNORE` and `executemany`,
+    without the per batch SQL building and row inspection of `insert_all`.
+    `columns` is the order of the values in the tuples, by default the column order of the
+    table, as created by `Datastore`.
+    """
+
+    def __init__(self, db: Database, table: str, columns: Optional[list[str]] = None) -> None:
+        if not db[table].exists():
+            raise ValueError(f"No {table} table, create it with Datastore.create_tables().")
+        self.db = db
+        self.columns = columns or row_columns(db, table)
+        stored, placeholders = stored_columns(db, table, self.columns)
+        names = ", ".join(f"[{column}]" for column in stored)
+        values = ", ".join(placeholders)
+        # The same SQL string every time, so sqlite3's statement cache keeps it prepared.
+        self.sql = f"INSERT OR IGNORE INTO [{table}] ({names}) VALUES ({values})"
+
+    def write(self, rows: Iterable[tuple[Any, ...]]) -> int:
+        """
+        Returns the number of rows inserted, rows whose key is already present are skipped.
+        """
+        with self.db.atomic():
+            return self.db.conn.executemany(self.sql, rows).rowcount
+
+
+CHANGE_KINDS = ["inserted", "updated", "deleted", "unchanged"]
+Changes = dict[str, dict[str, int]]  # table -> change kind -> rows.
+
+
+def merge_changes(*changes: Changes) -> Changes:
+    merged: Changes = {}
+    for change in changes:
+        for table, counts in change.items():
+            total = merged.setdefault(table, dict.fromkeys(CHANGE_KINDS, 0))
+            for kind, count in counts.items():
+                total[kind] += count
+    return merged
+
+
+def format_changes(changes: Changes) -> str:
+    return "\n".join(
+        f"{table} : " + ", ".join(f"{counts[kind]} {kind}" for kind in CHANGE_KINDS)
+        for table, counts in changes.items()
+    )
+
+
+class ChangeWriter:
+    """
+    Applies rows to `table` as changes. New rows are inserted, rows that differ from the stored
+    ones are updated, and identical ones are not written at all. With `tombstones`, `finish()`
+    marks the stored rows that were not applied as removed through their `removed_at`, and a
+    removed row that comes back is revived.
+    Rows are tuples in `columns` order or dicts, `columns` and `key` default to the columns and
+    primary key of the table. They are compared and written `batch_size` at a time.
+    `counts` holds the number of rows of every `CHANGE_KINDS`.
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        table: str,
+        columns: Optional[list[str]] = None,
+        key: Optional[list[str]] = None,
+        tombstones: bool = False,
+        batch_size: int = BATCH_SIZE,
+    ) -> None:
+        if not db[table].exists():
+            raise ValueError(f"No {table} table, create it with Datastore.create_tables().")
+        self.db = db
+        self.table = table
+        self.batch_size = batch_size
+        self.columns = columns or [
+            column for column in row_columns(db, table) if column != "removed_at"
+        ]
+        self.key = key or db[table].pks  # type: ignore
+        self.key_index = [self.columns.index(column) for column in self.key]
+        self.tombstones = tombstones
+        # Keys applied so far, only kept for `finish` to tombstone the others.
+        self.seen: set[tuple[Any, ...]] = set()
+        self.counts = dict.fromkeys(CHANGE_KINDS, 0)
+
+        names = ", ".join(f"[{column}]" for column in self.columns)
+        keys = ", ".join(f"[{column}]" for column in self.key)
+        stored = names + ", [removed_at]" if tombstones else names
+        key_values = ", ".join(f"json_extract(value, '$[{i}]')" for i in range(len(self.key)))
+        self.select_sql = (
+            f"SELECT {stored} FROM [{table}]"
+            f" WHERE ({keys}) IN (SELECT {key_values} FROM json_each(?))"
+        )
+        # Stored rows are read back through the ISO timestamp, and written through its `_ms`.
+        writes, placeholders = stored_columns(db, table, self.columns)
+        updates = [
+            f"[{w}] = excluded.[{w}]" for c, w in zip(self.columns, writes) if c not in self.key
+        ]
+        if tombstones:
+            updates.append("[removed_at] = NULL")
+        written = ", ".join(f"[{column}]" for column in writes)
+        self.upsert_sql = (
+            f"INSERT INTO [{table}] ({written}) VALUES ({', '.join(placeholders)})"
+            f" ON CONFLICT ({keys}) DO UPDATE SET {', '.join(updates)}"
+        )
+
+    def apply(self, rows: Iterable[Any]) -> None:
+        """
+        Write the rows that are new or changed, `batch_size` at a time. Can be called several
+        times, e.g. once per flush.
+        """
+        for batch in chunks(rows, self.batch_size):
+            self.apply_batch(batch)
+
+    def apply_batch(self, rows: Iterable[Any]) -> None:
+        """
+        Compare a batch of rows with their stored ones in a single query, and write the new and
+        changed ones in a single transaction.
+        """
+        batch: dict[tuple[Any, ...], tuple[Any, ...]] = {}
+        for row in rows:
+            if not isinstance(row, tuple):
+                row = tuple(row[column] for column in self.columns)
+            batch[tuple(row[i] for i in self.key_index)] = row
+        if not batch:
+            return
+        stored = {
+            tuple(row[i] for i in self.key_index): row
+            for row in self.db.execute(self.select_sql, [json.dumps(list(batch))])
+        }
+        changed = []
+        for key, row in batch.items():
+            old = stored.get(key)
+            if old is None:
+                kind = "inserted"
+            elif old[: len(row)] != row or (self.tombstones and old[-1] is not None):
+                kind = "updated"
+            else:
+                kind = "unchanged"
+            self.counts[kind] += 1
+            if kind != "unchanged":
+                changed.append(row)
+        if self.tombstones:
+            self.seen.update(batch)
+        with self.db.atomic():
+            self.db.conn.executemany(self.upsert_sql, changed)
+
+    def finish(self, where: str = "1", params: Iterable[Any] = ()) -> dict[str, int]:
+        """
+        Tombstone the live rows selected by `where` that were not applied. The applied rows must
+        be everything `where` covers, e.g. the full content of an endpoint.
+        """
+        if self.tombstones:
+            keys = ", ".join(f"[{column}]" for column in self.key)
+            live = self.db.execute(
+                f"SELECT {keys} FROM [{self.table}] WHERE removed_at IS NULL AND ({where})",
+                list(params),
+            )
+            gone = [key for key in map(tuple, live) if key not in self.seen]
+            conditions = " AND ".join(f"[{column}] = ?" for column in self.key)
+            removed_at = utc_now()
+            with self.db.atomic():
+                self.db.conn.executemany(
+                    f"UPDATE [{self.table}] SET removed_at = ? WHERE {conditions}",
+                    [(removed_at, *key) for key in gone],
+                )
+            self.counts["deleted"] += len(gone)
+        return self.counts
 
 
 class Datastore:
-    def __init__(self, db: Database) -> None:
+    """
+    Tables of a user's database. The catalog tables (shows, episodes, movies, genres and their
+    extended data) can live in a separate `catalog` database shared by several users, it is then
+    attached to the user's database so that queries joining both keep working unchanged.
+    With `epoch`, the timestamps of `EPOCH_COLUMNS` are stored as epoch milliseconds in the
+    tables it creates, see `create_timestamped`.
+    """
+
+    def __init__(
+        self, db: Database, catalog: Optional[Database] = None, epoch: bool = False
+    ) -> None:
         self.db = db
+        self.catalog = catalog or db
+        self.epoch = epoch
+        self.catalog_tables = [
+            "show",
+            "episode",
+            "movie",
+            "genre",
+            "extended_show",
+            "extended_episode",
+            "extended_movie",
+            "genre_mapping",
+            "enrichment_state",
+        ]
+        if self.catalog is not self.db:
+            # Several connections use the catalog, WAL lets them read while one writes,
+            # and writers wait for each other instead of failing with "database is locked".
+            self.catalog.enable_wal()
+            for db in [self.db, self.catalog]:
+                db.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT}")
+            catalog_path = self.catalog.execute("PRAGMA database_list").fetchone()[2]
+            if "catalog" not in [row[1] for row in self.db.execute("PRAGMA database_list")]:
+                self.db.attach("catalog", catalog_path)
         self.required_tables = [
             "show",
             "episode",
@@ -19,6 +277,13 @@ class Datastore:
             "extended_episode",
             "extended_movie",
             "genre_mapping",
+            "sync_state",
+            "enrichment_state",
+            "media_plays",
+            "daily_plays",
+            "monthly_plays",
+            "show_progress",
+            "genre_time",
         ]
 
         self.table_mapping: dict[str, Callable[[], None]] = {
@@ -34,10 +299,110 @@ class Datastore:
             "extended_movie": self.create_extended_movie,
             "extended_show": self.create_extended_show,
             "genre_mapping": self.create_genre_mapping,
+            "sync_state": self.create_sync_state,
+            "enrichment_state": self.create_enrichment_state,
+            "media_plays": self.create_media_plays,
+            "daily_plays": self.create_daily_plays,
+            "monthly_plays": self.create_monthly_plays,
+            "show_progress": self.create_show_progress,
+            "genre_time": self.create_genre_time,
+        }
+
+        # Secondary indexes for the media joins, filters and orderings of the reporting queries.
+        self.indexes: dict[str, list[list[str]]] = {
+            "watchlog": [["type", "media_id"], ["media_id"], ["watched_at"]],
+            "watchlist": [["type", "media_id"]],
+            "episode": [["show_id", "season", "number"]],
+        }
+
+        # Keep the play counts of `media_plays`, `daily_plays` and `monthly_plays` in step with
+        # the watchlog. Only rows actually inserted fire them, not the ignored duplicates.
+        self.triggers: dict[str, str] = {
+            "watchlog_plays_insert": """
+                AFTER INSERT ON watchlog BEGIN
+                    INSERT INTO media_plays
+                        (type, media_id, plays, first_watched_at, last_watched_at)
+                    VALUES (NEW.type, NEW.media_id, 1, NEW.watched_at, NEW.watched_at)
+                    ON CONFLICT (type, media_id) DO UPDATE SET
+                        plays = plays + 1,
+                        first_watched_at = min(first_watched_at, excluded.first_watched_at),
+                        last_watched_at = max(last_watched_at, excluded.last_watched_at);
+                    INSERT INTO daily_plays (day, type, plays)
+                    VALUES (substr(NEW.watched_at, 1, 10), NEW.type, 1)
+                    ON CONFLICT (day, type) DO UPDATE SET plays = plays + 1;
+                    INSERT INTO monthly_plays (month, type, plays)
+                    VALUES (substr(NEW.watched_at, 1, 7), NEW.type, 1)
+                    ON CONFLICT (month, type) DO UPDATE SET plays = plays + 1;
+                END
+            """,
+            "watchlog_plays_delete": """
+                AFTER DELETE ON watchlog BEGIN
+                    UPDATE media_plays SET
+                        plays = plays - 1,
+                        first_watched_at = (
+                            SELECT min(watched_at) FROM watchlog
+                            WHERE type = OLD.type AND media_id = OLD.media_id
+                        ),
+                        last_watched_at = (
+                            SELECT max(watched_at) FROM watchlog
+                            WHERE type = OLD.type AND media_id = OLD.media_id
+                        )
+                    WHERE type = OLD.type AND media_id = OLD.media_id;
+                    UPDATE daily_plays SET plays = plays - 1
+                    WHERE day = substr(OLD.watched_at, 1, 10) AND type = OLD.type;
+                    UPDATE monthly_plays SET plays = plays - 1
+                    WHERE month = substr(OLD.watched_at, 1, 7) AND type = OLD.type;
+                    DELETE FROM media_plays WHERE plays = 0;
+                    DELETE FROM daily_plays WHERE plays = 0;
+                    DELETE FROM monthly_plays WHERE plays = 0;
+                END
+            """,
+        }
+
+        # Add the plays of the watchlog rows `{rows}` to the tables kept by the triggers, the
+        # whole watchlog when they are created, the rows inserted by a bulk ingest after it.
+        self.plays_queries: dict[str, str] = {
+            "media_plays": (
+                "INSERT INTO media_plays"
+                " (type, media_id, plays, first_watched_at, last_watched_at)"
+                " SELECT type, media_id, count(*), min(watched_at), max(watched_at)"
+                " FROM {rows} GROUP BY type, media_id"
+                " ON CONFLICT (type, media_id) DO UPDATE SET plays = plays + excluded.plays,"
+                " first_watched_at = min(first_watched_at, excluded.first_watched_at),"
+                " last_watched_at = max(last_watched_at, excluded.last_watched_at)"
+            ),
+            "daily_plays": (
+                "INSERT INTO daily_plays (day, type, plays)"
+                " SELECT substr(watched_at, 1, 10), type, count(*) FROM {rows} GROUP BY 1, 2"
+                " ON CONFLICT (day, type) DO UPDATE SET plays = plays + excluded.plays"
+            ),
+            "monthly_plays": (
+                "INSERT INTO monthly_plays (month, type, plays)"
+                " SELECT substr(watched_at, 1, 7), type, count(*) FROM {rows} GROUP BY 1, 2"
+                " ON CONFLICT (month, type) DO UPDATE SET plays = plays + excluded.plays"
+            ),
+        }
+
+        # Extended data searchable through their FTS5 `<table>_fts` index, with the weight of
+        # every column in the ranking, titles counting the most.
+        self.search_columns: dict[str, dict[str, float]] = {
+            "extended_show": {"title": 10.0, "overview": 1.0},
+            "extended_movie": {"title": 10.0, "tagline": 2.0, "overview": 1.0},
+            "extended_episode": {"title": 10.0, "overview": 1.0},
+        }
+
+        # Tables whose rows are tombstoned by a `removed_at`, instead of being deleted.
+        self.tombstoned_tables = ["ratings", "collected", "watchlist"]
+
+        # Incrementally synced resources, and the query giving their high-water mark.
+        # `{latest}` is the latest `watched_at`, see `latest`.
+        self.watermark_queries: dict[str, str] = {
+            "history/episodes": "select {latest} from watchlog where type = 'episode'",
+            "history/movies": "select {latest} from watchlog where type = 'movie'",
         }
 
     def create_show(self):
-        self.db["show"].create(  # type: ignore
+        self.catalog["show"].create(  # type: ignore
             {
                 "type": str,
                 "id": int,
@@ -56,7 +421,7 @@ class Datastore:
         )
 
     def create_episode(self):
-        self.db["episode"].create(  # type: ignore
+        self.catalog["episode"].create(  # type: ignore
             {
                 "type": str,
                 "id": int,
@@ -77,7 +442,7 @@ class Datastore:
         )
 
     def create_movie(self):
-        self.db["movie"].create(  # type: ignore
+        self.catalog["movie"].create(  # type: ignore
             {
                 "type": str,
                 "id": int,
@@ -93,132 +458,413 @@ class Datastore:
             defaults={"type": "movie"},
         )
 
+    def create_timestamped(
+        self,
+        table: str,
+        columns: dict[str, Any],
+        media_foreign_keys: list[tuple[str, str, str, str]],
+        **kwargs: Any,
+    ) -> None:
+        """
+        Create `table` and its media foreign keys. With epoch its timestamp is stored as INTEGER
+        milliseconds in a `<column>_ms` column, cheaper to compare, bucket and index, and a third
+        of the size, and the ISO text column is generated from it by `ensure_columns`.
+        """
+        column = EPOCH_COLUMNS[table]
+        if self.epoch:
+            epoch = f"{column}_ms"
+            columns = {
+                epoch if c == column else c: int if c == column else t for c, t in columns.items()
+            }
+            kwargs["not_null"] = {epoch if c == column else c for c in kwargs["not_null"]}
+        self.db[table].create(columns, **kwargs)  # type: ignore
+        self.add_media_foreign_keys(media_foreign_keys)
+        self.ensure_columns()
+
     # Single table for all watched entities. (Movies and Episodes.)
     def create_watchlog(self):
-        self.db["watchlog"].create(  # type: ignore
+        self.create_timestamped(
+            "watchlog",
             {
                 "id": int,
                 "type": str,  # movie / episode
                 "media_id": int,  # corresponding primary key of the entity.
                 "watched_at": str,
             },
+            [("watchlog", "media_id", "movie", "id"), ("watchlog", "media_id", "episode", "id")],
             pk="id",
             not_null={"id", "media_id", "watched_at"},
             # foreign_keys=["media_id"],
         )
 
-        self.db.add_foreign_keys(
-            [("watchlog", "media_id", "movie", "id"), ("watchlog", "media_id", "episode", "id")]
-        )
-
     # Single table for all collected entities. (Movies and Episodes.)
     def create_collected(self):
-        self.db["collected"].create(  # type: ignore
+        self.create_timestamped(
+            "collected",
             {
-                "id": str,
                 "type": str,  # movie / episode
                 "media_id": int,  # corresponding primary key of the entity.
                 "collected_at": str,
+                "removed_at": str,  # set once the item left the collection.
             },
-            pk="id",
-            not_null={"id", "media_id", "collected_at"},
+            [("collected", "media_id", "movie", "id"), ("collected", "media_id", "episode", "id")],
+            pk=("type", "media_id"),
+            not_null={"type", "media_id", "collected_at"},
             # foreign_keys=["media_id"],
         )
 
-        self.db.add_foreign_keys(
-            [("collected", "media_id", "movie", "id"), ("collected", "media_id", "episode", "id")]
-        )
-
     # Single table for all collected entities. (Movies and Episodes.)
     def create_ratings(self):
-        self.db["ratings"].create(  # type: ignore
+        self.create_timestamped(
+            "ratings",
             {
-                "id": str,
                 "type": str,  # movie / episode / show
                 "media_id": int,  # corresponding primary key of the entity.
                 "rating": int,
                 "rated_at": str,
+                "removed_at": str,  # set once the rating was removed.
             },
-            pk="id",
-            not_null={"id", "media_id", "rating"},
-            # foreign_keys=["media_id"],
-        )
-
-        self.db.add_foreign_keys(
             [
                 ("ratings", "media_id", "movie", "id"),
                 ("ratings", "media_id", "episode", "id"),
                 ("ratings", "media_id", "show", "id"),
-            ]
+            ],
+            pk=("type", "media_id"),
+            not_null={"type", "media_id", "rating"},
+            # foreign_keys=["media_id"],
         )
 
     # Single table for all watchlist-ed entities. (Movies and Shows.)
     def create_watchlist(self):
-        self.db["watchlist"].create(  # type: ignore
+        self.create_timestamped(
+            "watchlist",
             {
                 "id": int,
                 "type": str,  # movie / episode / show
                 "media_id": int,  # corresponding primary key of the entity.
                 "watchlisted_at": str,
+                "removed_at": str,  # set once the item left the watchlist.
             },
+            [
+                ("watchlist", "media_id", "movie", "id"),
+                ("watchlist", "media_id", "show", "id"),
+            ],
             pk="id",
             not_null={"id", "media_id", "watchlisted_at"},
             # foreign_keys=["media_id"],
         )
 
-        self.db.add_foreign_keys(
-            [
-                ("watchlist", "media_id", "movie", "id"),
-                ("watchlist", "media_id", "show", "id"),
-            ]
-        )
+    def home(self, table: str) -> Database:
+        """
+        Database that `table` lives in.
+        """
+        return self.catalog if table in self.catalog_tables else self.db
+
+    def add_media_foreign_keys(self, foreign_keys: list[tuple[str, str, str, str]]) -> None:
+        # SQLite can't reference tables of another database, so these are only
+        # declared when the catalog is not separate.
+        if self.catalog is self.db:
+            self.db.add_foreign_keys(foreign_keys)
+
+    def migrate_to_catalog(self) -> None:
+        """
+        Move the catalog tables of a user's database created before it used a separate catalog
+        into the catalog, so that they stop shadowing the attached ones.
+        """
+        if self.catalog is self.db:
+            return
+        self.create_tables()
+        for table in self.catalog_tables:
+            if table not in self.db.table_names():
+                continue
+            columns = ", ".join(f"[{column}]" for column in self.db[table].columns_dict)
+            with self.db.atomic():
+                self.db.execute(
+                    f"INSERT OR IGNORE INTO catalog.[{table}] ({columns})"
+                    f" SELECT {columns} FROM main.[{table}]"
+                )
+                self.db.execute(f"DROP TABLE main.[{table}]")
+                # Its index would shadow the catalog's one.
+                self.db.execute(f"DROP TABLE IF EXISTS main.[{table}_fts]")
+
+    def migrate_natural_keys(self) -> None:
+        """
+        Rebuild the `ratings`, `collected`, `genre` and `genre_mapping` tables of databases
+        created while they were keyed by a SHA1 `id`, with their natural keys.
+        Duplicated ratings and collected items keep their latest row.
+        Genre mappings without a `type` take the one of the extended show or movie they point
+        at. When both a show and a movie have their id, the mappings can't be told apart, so
+        both are dropped along with the extended rows, for the next enrichment to fetch again.
+        """
+
+        def hashed(table: str) -> bool:
+            db = self.home(table)
+            return table in db.table_names() and "id" in db[table].columns_dict
+
+        def untyped(table: str) -> bool:
+            db = self.home(table)
+            return table in db.table_names() and "type" not in db[table].columns_dict
+
+        def rebuild(table: str, copy: str, suffix: str = "hashed") -> None:
+            db = self.home(table)
+            db.execute(f"ALTER TABLE [{table}] RENAME TO [{table}_{suffix}]")
+            self.table_mapping[table]()
+            db.execute(copy)
+            db.execute(f"DROP TABLE [{table}_{suffix}]")
+            print(f"Migrated {table} to natural keys.")
+
+        for table, at in [("ratings", "rated_at"), ("collected", "collected_at")]:
+            if hashed(table):
+                columns = ", ".join(
+                    column for column in self.db[table].columns_dict if column != "id"
+                )
+                with self.db.atomic():
+                    rebuild(
+                        table,
+                        f"INSERT OR REPLACE INTO [{table}] ({columns}) SELECT {columns}"
+                        f" FROM [{table}_hashed] WHERE type IS NOT NULL ORDER BY [{at}]",
+                    )
+        with self.catalog.atomic():
+            # The mappings point at the hashed ids, so they are rebuilt before the genres.
+            if untyped("genre_mapping"):
+                ambiguous = [
+                    row[0]
+                    for row in self.catalog.execute(
+                        "SELECT DISTINCT M.media_id FROM genre_mapping M"
+                        " INNER JOIN extended_show S ON S.id = M.media_id"
+                        " INNER JOIN extended_movie V ON V.id = M.media_id"
+                    )
+                ]
+                for table in ["extended_show", "extended_movie"]:
+                    self.catalog.execute(
+                        f"DELETE FROM [{table}] WHERE id IN (SELECT value FROM json_each(?))",
+                        [json.dumps(ambiguous)],
+                    )
+                suffix = "hashed" if hashed("genre_mapping") else "untyped"
+                mappings = (
+                    "(SELECT M.media_id, G.slug AS genre_id FROM genre_mapping_hashed M"
+                    " INNER JOIN genre G ON G.id = M.genre_id)"
+                    if suffix == "hashed"
+                    else "genre_mapping_untyped"
+                )
+                rebuild(
+                    "genre_mapping",
+                    "INSERT OR IGNORE INTO genre_mapping (type, media_id, genre_id)"
+                    f" SELECT 'show', M.media_id, M.genre_id FROM {mappings} M"
+                    " INNER JOIN extended_show X ON X.id = M.media_id"
+                    " UNION ALL"
+                    f" SELECT 'movie', M.media_id, M.genre_id FROM {mappings} M"
+                    " INNER JOIN extended_movie X ON X.id = M.media_id",
+                    suffix,
+                )
+            if hashed("genre"):
+                rebuild(
+                    "genre",
+                    "INSERT OR IGNORE INTO genre (slug, name) SELECT slug, name FROM genre_hashed"
+                    " WHERE slug IS NOT NULL",
+                )
+        self.ensure_indexes()
+
+    def migrate_epoch_timestamps(self) -> None:
+        """
+        With `epoch`, rebuild the tables of `EPOCH_COLUMNS` that store their timestamp as ISO
+        text, with the timestamp as epoch milliseconds.
+        """
+        if not self.epoch:
+            return
+        for table, column in EPOCH_COLUMNS.items():
+            if table not in self.db.table_names() or epoch_column(self.db, table):
+                continue
+            columns = list(self.db[table].columns_dict)
+            stored = ", ".join(f"[{c}_ms]" if c == column else f"[{c}]" for c in columns)
+            values = ", ".join(
+                TO_EPOCH_MS.format(f"[{c}]") if c == column else f"[{c}]" for c in columns
+            )
+            with self.db.atomic():
+                self.db.execute(f"ALTER TABLE [{table}] RENAME TO [{table}_iso]")
+                self.table_mapping[table]()
+                self.db.execute(
+                    f"INSERT INTO [{table}] ({stored}) SELECT {values} FROM [{table}_iso]"
+                )
+                self.db.execute(f"DROP TABLE [{table}_iso]")
+            print(f"Migrated {table} to epoch timestamps.")
+        self.ensure_columns()
+        self.ensure_indexes()
+        self.ensure_triggers()
+
+    @contextmanager
+    def bulk_ingest(self) -> Generator[Database, Any, Any]:
+        """
+        Run an ingestion stage as a single transaction, with WAL journaling and `BULK_PRAGMAS`.
+        The previous settings are restored once the stage is over.
+        A separate catalog only gets the pragmas, its writes keep committing per flush. A stage
+        also waits on the api, holding the catalog's write lock for all of it would make the
+        users sharing the catalog run one at a time.
+        """
+        databases = [self.db] if self.catalog is self.db else [self.db, self.catalog]
+        previous = [
+            {pragma: db.execute(f"PRAGMA {pragma}").fetchone()[0] for pragma in BULK_PRAGMAS}
+            for db in databases
+        ]
+        journal_modes = [db.journal_mode for db in databases]
+        for db in databases:
+            db.enable_wal()
+            for pragma, value in BULK_PRAGMAS.items():
+                db.execute(f"PRAGMA {pragma}={value}")
+        try:
+            with self.db.atomic():
+                with self.deferred_plays():
+                    yield self.db
+        finally:
+            for db, pragmas, journal_mode in zip(databases, previous, journal_modes):
+                for pragma, value in pragmas.items():
+                    db.execute(f"PRAGMA {pragma}={value}")
+                if journal_mode != "wal":
+                    # Unqualified, the journal mode would also be set on the attached catalog.
+                    db.execute(f"PRAGMA main.journal_mode={journal_mode}")
 
     def assert_tables(self) -> bool:
         return all(
-            [True if table in self.db.table_names() else False for table in self.required_tables]
+            [
+                True if table in self.home(table).table_names() else False
+                for table in self.required_tables
+            ]
         )
 
     def create_tables(self) -> None:
         for table in self.required_tables:
-            if table not in self.db.table_names():
+            if table not in self.home(table).table_names():
                 table_creation_func = self.table_mapping[table]
                 table_creation_func()
+        self.ensure_columns()
+        self.ensure_indexes()
+        self.ensure_triggers()
+        self.ensure_search()
+
+    def ensure_columns(self) -> None:
+        """
+        Add the `removed_at` column to tombstoned tables created before it was declared, and
+        the ISO timestamp generated from the epoch milliseconds of the tables storing them.
+        Generated columns are added once the table is created, as rebuilding it to add its
+        foreign keys would lose them.
+        """
+        for table in self.tombstoned_tables:
+            db = self.home(table)
+            if table in db.table_names() and "removed_at" not in db[table].columns_dict:
+                db[table].add_column("removed_at", str)  # type: ignore
+        for table in EPOCH_COLUMNS:
+            if table not in self.db.table_names() or not epoch_column(self.db, table):
+                continue
+            column = EPOCH_COLUMNS[table]
+            if column not in [row[1] for row in self.db.execute(f"PRAGMA table_xinfo([{table}])")]:
+                self.db.execute(
+                    f"ALTER TABLE [{table}] ADD COLUMN [{column}] TEXT"
+                    f" GENERATED ALWAYS AS ({FROM_EPOCH_MS.format(f'[{column}_ms]')}) VIRTUAL"
+                )
+
+    def ensure_indexes(self) -> None:
+        """
+        Create any index in `indexes` that is missing, so that databases created
+        before an index was declared pick it up.
+        """
+        for table, indexes in self.indexes.items():
+            if table not in self.home(table).table_names():
+                continue
+            # An epoch timestamp is indexed through its `_ms` column.
+            epoch = epoch_column(self.home(table), table)
+            for columns in indexes:
+                columns = [f"{c}_ms" if c == epoch else c for c in columns]
+                self.home(table)[table].create_index(  # type: ignore
+                    columns, if_not_exists=True
+                )
+
+    def ensure_triggers(self) -> None:
+        """
+        Create any trigger in `triggers` that is missing, they are dropped along with the
+        watchlog whenever it is rebuilt.
+        """
+        if "watchlog" not in self.db.table_names():
+            return
+        for name, trigger in self.triggers.items():
+            self.db.execute(f"CREATE TRIGGER IF NOT EXISTS [{name}] {trigger}")
+
+    def ensure_search(self) -> None:
+        """
+        Create the FTS5 index of every table in `search_columns` that is missing, filled from the
+        rows already there. sqlite-utils triggers then keep it in sync with the table.
+        """
+        for table, weights in self.search_columns.items():
+            if table not in self.catalog.table_names() or self.catalog[table].detect_fts():
+                continue
+            self.catalog[table].enable_fts(  # type: ignore
+                list(weights), create_triggers=True, tokenize="porter"
+            )
+            # bm25() takes the weights in column order, stored as the default ranking.
+            bm25 = ", ".join(str(weight) for weight in weights.values())
+            self.catalog.execute(
+                f"INSERT INTO [{table}_fts] ([{table}_fts], rank) VALUES ('rank', 'bm25({bm25})')"
+            )
+
+    def search(
+        self,
+        query: str,
+        types: Iterable[str] = ("show", "movie", "episode"),
+        limit: int = 20,
+        quote: bool = True,
+    ) -> list[tuple[str, int, float]]:
+        """
+        (type, id, rank) of the extended shows, movies and episodes matching `query`, best first.
+        `query` is searched as plain words, unless `quote` is False and it is an FTS5 query.
+        Ranks are bm25 scores, the lower the better.
+        """
+        if quote:
+            query = self.catalog.quote_fts(query)
+        selects, params = [], []
+        for media_type in types:
+            fts = f"extended_{media_type}_fts"
+            # Each index is ranked and cut on its own, before merging them.
+            selects.append(
+                f"SELECT * FROM (SELECT '{media_type}', rowid, rank FROM [{fts}]"
+                f" WHERE [{fts}] MATCH ? ORDER BY rank LIMIT ?)"
+            )
+            params += [query, limit]
+        sql = " UNION ALL ".join(selects) + " ORDER BY 3 LIMIT ?"
+        return self.catalog.execute(sql, params + [limit]).fetchall()
 
     def get_shows_in_db(self) -> Generator[dict[str, str], Any, Any]:
-        return self.db["show"].rows  # type: ignore
+        return self.catalog["show"].rows  # type: ignore
 
     def get_episodes_join_shows_in_db(self) -> Generator[dict[str, str], Any, Any]:
-        return self.db.query("select E.id AS eid, E.season AS eseason, E.number AS enumber, E.title AS etitle, S.id, S.title, S.year, S.trakt_slug from episode E INNER JOIN show S on E.show_id = S.id")  # type: ignore
+        return self.catalog.query("select E.id AS eid, E.season AS eseason, E.number AS enumber, E.title AS etitle, S.id, S.title, S.year, S.trakt_slug from episode E INNER JOIN show S on E.show_id = S.id")  # type: ignore
 
     def get_movies_in_db(self) -> Generator[dict[str, str], Any, Any]:
-        return self.db["movie"].rows  # type: ignore
+        return self.catalog["movie"].rows  # type: ignore
 
     # Single table for all genres.
     def create_genre(self):
-        self.db["genre"].create(  # type: ignore
+        self.catalog["genre"].create(  # type: ignore
             {
-                "id": str,
-                "name": str,  # genre name
                 "slug": str,  # genre slug
+                "name": str,  # genre name
             },
-            pk="id",
-            not_null={"id", "name"},
+            pk="slug",
+            not_null={"slug", "name"},
         )
 
     # Single table for all media entities.
-    # Media -> genre mapping.
+    # Media -> genre mapping. Show and movie ids overlap, so the mappings carry the media type.
     def create_genre_mapping(self):
-        self.db["genre_mapping"].create(  # type: ignore
+        self.catalog["genre_mapping"].create(  # type: ignore
             {
-                "id": str,
+                "type": str,  # show / movie
                 "media_id": int,
-                "genre_id": str,  # genre id
+                "genre_id": str,  # genre slug
             },
-            pk="id",
-            not_null={"id", "media_id", "genre_id"},
+            pk=("type", "media_id", "genre_id"),
+            not_null={"type", "media_id", "genre_id"},
         )
 
-        self.db.add_foreign_keys(
+        self.catalog.add_foreign_keys(
             [
                 ("genre_mapping", "media_id", "extended_show", "id"),
                 ("genre_mapping", "media_id", "extended_movie", "id"),
@@ -227,7 +873,7 @@ class Datastore:
         )
 
     def create_extended_show(self):
-        self.db["extended_show"].create(  # type: ignore
+        self.catalog["extended_show"].create(  # type: ignore
             {
                 "type": str,
                 "id": int,
@@ -260,7 +906,7 @@ class Datastore:
         )
 
     def create_extended_episode(self):
-        self.db["extended_episode"].create(  # type: ignore
+        self.catalog["extended_episode"].create(  # type: ignore
             {
                 "type": str,
                 "id": int,
@@ -292,14 +938,14 @@ class Datastore:
             not_null={"id", "season", "number", "trakt_id", "show_id"},
             defaults={"type": "episode"},
         )
-        self.db.add_foreign_keys(
+        self.catalog.add_foreign_keys(
             [
                 ("extended_episode", "show_id", "extended_show", "id"),
             ]
         )
 
     def create_extended_movie(self):
-        self.db["extended_movie"].create(  # type: ignore
+        self.catalog["extended_movie"].create(  # type: ignore
             {
                 "type": str,
                 "id": int,
@@ -327,3 +973,287 @@ class Datastore:
             not_null={"id", "title", "trakt_id"},
             defaults={"type": "movie"},
         )
+
+    # Per resource high-water marks, for incremental syncs.
+    def create_sync_state(self):
+        self.db["sync_state"].create(  # type: ignore
+            {
+                "resource": str,  # {item}/{endpoint}, ex : history/episodes
+                "watermark": str,  # latest timestamp ingested for the resource.
+                "synced_at": str,
+            },
+            pk="resource",
+            not_null={"resource"},
+        )
+
+    # Progress of the interrupted enrichment of an extended_* table.
+    def create_enrichment_state(self):
+        self.catalog["enrichment_state"].create(  # type: ignore
+            {
+                "name": str,  # extended_* table being enriched.
+                "checkpoint": int,  # every base row up to this id has been enriched.
+                "updated_at": str,
+            },
+            pk="name",
+            not_null={"name"},
+        )
+
+    # Play counts of every watched episode and movie, kept by the watchlog triggers.
+    def create_media_plays(self):
+        self.db["media_plays"].create(  # type: ignore
+            {
+                "type": str,  # movie / episode
+                "media_id": int,
+                "plays": int,
+                "first_watched_at": str,
+                "last_watched_at": str,
+            },
+            pk=("type", "media_id"),
+            not_null={"type", "media_id", "plays"},
+        )
+        self.db.execute(self.plays_queries["media_plays"].format(rows="watchlog"))
+
+    # Plays per UTC day, kept by the watchlog triggers.
+    def create_daily_plays(self):
+        self.db["daily_plays"].create(  # type: ignore
+            {
+                "day": str,  # YYYY-MM-DD
+                "type": str,  # movie / episode
+                "plays": int,
+            },
+            pk=("day", "type"),
+            not_null={"day", "type", "plays"},
+        )
+        self.db.execute(self.plays_queries["daily_plays"].format(rows="watchlog"))
+
+    # Plays per UTC month, kept by the watchlog triggers.
+    def create_monthly_plays(self):
+        self.db["monthly_plays"].create(  # type: ignore
+            {
+                "month": str,  # YYYY-MM
+                "type": str,  # movie / episode
+                "plays": int,
+            },
+            pk=("month", "type"),
+            not_null={"month", "type", "plays"},
+        )
+        self.db.execute(self.plays_queries["monthly_plays"].format(rows="watchlog"))
+
+    # Watched episodes of every show, rebuilt by `refresh_aggregates`.
+    def create_show_progress(self):
+        self.db["show_progress"].create(  # type: ignore
+            {
+                "show_id": int,
+                "watched_episodes": int,  # distinct episodes watched.
+                "plays": int,
+                "aired_episodes": int,  # from the extended data, when fetched.
+                "last_watched_at": str,
+            },
+            pk="show_id",
+            not_null={"show_id", "watched_episodes", "plays"},
+        )
+
+    # Plays and minutes watched per genre, rebuilt by `refresh_aggregates`.
+    def create_genre_time(self):
+        self.db["genre_time"].create(  # type: ignore
+            {
+                "genre_id": str,  # genre slug
+                "type": str,  # movie / episode
+                "plays": int,
+                "minutes": int,  # plays times the runtime, when fetched.
+            },
+            pk=("genre_id", "type"),
+            not_null={"genre_id", "type", "plays", "minutes"},
+        )
+
+    @contextmanager
+    def deferred_plays(self) -> Generator[Database, Any, Any]:
+        """
+        Replace the watchlog insert trigger for the duration of the block by one that only records
+        the ids of the inserted rows, and add their plays once the block is over. Cheaper than
+        the three upserts of the trigger for every row of a bulk ingest, and only the inserted
+        rows are read again. Meant to be run inside a transaction, so that a failure restores it.
+        The delete trigger is kept, watchlog rows inserted then deleted in the same block would
+        be taken off counts they were never added to.
+        """
+        if not all(table in self.db.table_names() for table in ["watchlog", *self.plays_queries]):
+            yield self.db
+            return
+        self.db.execute("DROP TRIGGER IF EXISTS [watchlog_plays_insert]")
+        self.db.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS watchlog_inserted (id INTEGER PRIMARY KEY)"
+        )
+        self.db.execute("DELETE FROM temp.watchlog_inserted")
+        self.db.execute(
+            "CREATE TEMP TRIGGER IF NOT EXISTS watchlog_inserted_ids AFTER INSERT ON main.watchlog"
+            " BEGIN INSERT OR IGNORE INTO watchlog_inserted (id) VALUES (NEW.id); END"
+        )
+        try:
+            yield self.db
+        finally:
+            self.db.execute("DROP TRIGGER IF EXISTS temp.watchlog_inserted_ids")
+        inserted = (
+            "(SELECT W.* FROM temp.watchlog_inserted I INNER JOIN main.watchlog W ON W.id = I.id)"
+        )
+        for query in self.plays_queries.values():
+            self.db.execute(query.format(rows=inserted))
+        self.db.execute("DELETE FROM temp.watchlog_inserted")
+        self.ensure_triggers()
+
+    def refresh_aggregates(self) -> None:
+        """
+        Rebuild `show_progress` and `genre_time` from `media_plays` and the catalog, so they
+        cost a pass over the watched media rather than over the whole watchlog.
+        They depend on catalog tables, that the watchlog triggers can't reach once the catalog
+        is a separate database, so they are refreshed after each ingestion and enrichment.
+        """
+        with self.db.atomic():
+            self.db.execute("DELETE FROM show_progress")
+            self.db.execute(
+                "INSERT INTO show_progress"
+                " (show_id, watched_episodes, plays, aired_episodes, last_watched_at)"
+                " SELECT E.show_id, count(*), sum(P.plays), X.aired_episodes,"
+                " max(P.last_watched_at) FROM media_plays P"
+                " INNER JOIN episode E ON E.id = P.media_id"
+                " LEFT JOIN extended_show X ON X.id = E.show_id"
+                " WHERE P.type = 'episode' GROUP BY E.show_id"
+            )
+            self.db.execute("DELETE FROM genre_time")
+            # Episodes take the genres of their show, and its runtime when theirs is missing.
+            self.db.execute(
+                "INSERT INTO genre_time (genre_id, type, plays, minutes)"
+                " SELECT G.genre_id, 'episode', sum(P.plays),"
+                " sum(P.plays * coalesce(XE.runtime, XS.runtime, 0)) FROM media_plays P"
+                " INNER JOIN episode E ON E.id = P.media_id"
+                " INNER JOIN genre_mapping G ON G.type = 'show' AND G.media_id = E.show_id"
+                " LEFT JOIN extended_episode XE ON XE.id = P.media_id"
+                " LEFT JOIN extended_show XS ON XS.id = E.show_id"
+                " WHERE P.type = 'episode' GROUP BY G.genre_id"
+                " UNION ALL"
+                " SELECT G.genre_id, 'movie', sum(P.plays),"
+                " sum(P.plays * coalesce(XM.runtime, 0)) FROM media_plays P"
+                " INNER JOIN genre_mapping G ON G.type = 'movie' AND G.media_id = P.media_id"
+                " LEFT JOIN extended_movie XM ON XM.id = P.media_id"
+                " WHERE P.type = 'movie' GROUP BY G.genre_id"
+            )
+
+    def get_checkpoint(self, name: str) -> Optional[int]:
+        rows = list(
+            self.catalog["enrichment_state"].rows_where("name = ?", [name])  # type: ignore
+        )
+        return rows[0]["checkpoint"] if rows else None  # type: ignore
+
+    def set_checkpoint(self, name: str, checkpoint: int) -> None:
+        self.catalog["enrichment_state"].insert(  # type: ignore
+            {"name": name, "checkpoint": checkpoint, "updated_at": utc_now()}, replace=True
+        )
+
+    def clear_checkpoint(self, name: str) -> None:
+        """
+        Called once an enrichment run completes, so the next one starts over from the first row.
+        """
+        self.catalog["enrichment_state"].delete_where("name = ?", [name])  # type: ignore
+
+    def get_unenriched_keys(self, query: str, name: str) -> sqlite3.Cursor:
+        # `name` is the enrichment whose checkpoint the query resumes after.
+        checkpoint = self.get_checkpoint(name)
+        return self.catalog.execute(query, [checkpoint if checkpoint is not None else -1])
+
+    def get_unenriched_movie_keys(self) -> sqlite3.Cursor:
+        """
+        (id, trakt_slug) of the movies missing from extended_movie, in id order,
+        resuming after the checkpoint of an interrupted enrichment.
+        """
+        return self.get_unenriched_keys(
+            "select M.id, M.trakt_slug from movie M left join extended_movie X on X.id = M.id"
+            " where X.id is null and M.id > ? order by M.id",
+            "extended_movie",
+        )
+
+    def get_unenriched_show_keys(self) -> sqlite3.Cursor:
+        """
+        (id, trakt_slug) of the shows missing from extended_show, in id order,
+        resuming after the checkpoint of an interrupted enrichment.
+        """
+        return self.get_unenriched_keys(
+            "select S.id, S.trakt_slug from show S left join extended_show X on X.id = S.id"
+            " where X.id is null and S.id > ? order by S.id",
+            "extended_show",
+        )
+
+    def get_unenriched_episode_keys(self) -> sqlite3.Cursor:
+        """
+        (id, show_id, show trakt_slug, season, number) of the episodes missing from
+        extended_episode, in id order, resuming after the checkpoint of an interrupted enrichment.
+        """
+        return self.get_unenriched_keys(
+            "select E.id, E.show_id, S.trakt_slug, E.season, E.number from episode E"
+            " inner join show S on S.id = E.show_id"
+            " left join extended_episode X on X.id = E.id"
+            " where X.id is null and E.id > ? order by E.id",
+            "extended_episode",
+        )
+
+    def get_unenriched_show_episode_keys(self) -> Generator[tuple[int, str, list[Any]], Any, Any]:
+        """
+        (show_id, show trakt_slug, [(id, season, number), ...]) of every show with episodes
+        missing from extended_episode, in show_id order, resuming after the checkpoint of an
+        interrupted season level enrichment.
+        """
+        cursor = self.get_unenriched_keys(
+            "select E.show_id, S.trakt_slug, E.id, E.season, E.number from episode E"
+            " inner join show S on S.id = E.show_id"
+            " left join extended_episode X on X.id = E.id"
+            " where X.id is null and E.show_id > ? order by E.show_id, E.id",
+            "extended_episode_seasons",
+        )
+        for (show_id, show_slug), rows in groupby(cursor, key=lambda row: (row[0], row[1])):
+            yield show_id, show_slug, [row[2:] for row in rows]
+
+    def get_episode_numbers_by_show(self, show_ids: list[int]) -> dict[int, set[tuple[int, int]]]:
+        """
+        (season, number) of the episodes in the db of each show in `show_ids`.
+        """
+        numbers: dict[int, set[tuple[int, int]]] = {}
+        rows = self.catalog.execute(
+            "SELECT show_id, season, number FROM episode"
+            " WHERE show_id IN (SELECT value FROM json_each(?))",
+            [json.dumps(show_ids)],
+        )
+        for show_id, season, number in rows:
+            numbers.setdefault(show_id, set()).add((season, number))
+        return numbers
+
+    def get_watermarks(self) -> dict[str, str]:
+        return {
+            row["resource"]: row["watermark"]  # type: ignore
+            for row in self.db["sync_state"].rows  # type: ignore
+            if row["watermark"]  # type: ignore
+        }
+
+    def latest(self, table: str) -> str:
+        """
+        SQL of the latest ISO timestamp of `table`, taken from the integer column when it is
+        stored as epoch milliseconds so that its index is used.
+        """
+        column = EPOCH_COLUMNS[table]
+        if epoch_column(self.db, table):
+            return FROM_EPOCH_MS.format(f"max([{column}_ms])")
+        return f"max([{column}])"
+
+    def update_watermarks(self) -> None:
+        """
+        Record the latest timestamp ingested for every resource in `watermark_queries`.
+        """
+        synced_at = utc_now()
+        rows = [
+            {
+                "resource": resource,
+                "watermark": self.db.execute(
+                    query.format(latest=self.latest("watchlog"))
+                ).fetchone()[0],
+                "synced_at": synced_at,
+            }
+            for resource, query in self.watermark_queries.items()
+        ]
+        self.db["sync_state"].upsert_all(rows, pk="resource")  # type: ignore
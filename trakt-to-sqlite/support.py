@@ -1,20 +1,54 @@
 import os
-import json
-from typing import Any
+from typing import Any, Generator, Iterable
 
 from sqlite_utils import Database
 
+import codec
+from decode import RowDecoder, Rows
+
 
 def load_json(file_path: str) -> Any:
     assert os.path.isfile(file_path)
-    with open(file_path, "r") as f:
-        data = json.load(f)
+    with open(file_path, "rb") as f:
+        data = codec.loads(f.read())
     return data
 
 
+def iter_lines(file_path: str) -> Generator[bytes, None, None]:
+    assert os.path.isfile(file_path)
+    with open(file_path, "rb") as f:
+        for line in f:
+            if line.strip():
+                yield line
+
+
+def iter_json_lines(file_path: str) -> Iterable[Any]:
+    return map(codec.loads, iter_lines(file_path))
+
+
+def read_entries(file_path: str) -> Iterable[Any]:
+    """
+    Iterate over a backed up endpoint, streamed as json lines or from an older `.json` backup.
+    """
+    if file_path.endswith(".jsonl"):
+        return iter_json_lines(file_path)
+    return load_json(file_path)
+
+
+def read_rows(file_path: str, decoder: RowDecoder[Rows]) -> Iterable[Rows]:
+    """
+    Rows of every entry of a backed up endpoint, decoded from the raw json by `decoder`.
+    """
+    if file_path.endswith(".jsonl"):
+        return map(decoder.decode, iter_lines(file_path))
+    assert os.path.isfile(file_path)
+    with open(file_path, "rb") as f:
+        return decoder.decode_page(f.read())
+
+
 def get_genre_cache(db: Database) -> dict[str, str]:
-    d: dict[str, str] = {}  # genre - genre_id mapping.
+    d: dict[str, str] = {}  # genre - genre_id (slug) mapping.
     for row in db["genre"].rows:  # type: ignore
-        name, id = row["name"], row["id"]  # type: ignore
+        name, id = row["name"], row["slug"]  # type: ignore
         d[name] = id  # type: ignore
     return d
@@ -10,6 +10,12 @@ class MediaGenreRow(Genre):
     media_id: int
 
 
+class GenreMappingRow(TypedDict):
+    type: str  # show / movie
+    media_id: int
+    genre_id: str
+
+
 class ShowBare(TypedDict):
     title: str  # "Parks and Recreation"
     year: int  # 2009
@@ -172,10 +178,20 @@ class HistoryEpisode(Episode, Show):  # type: ignore
     type: str  # episode
 
 
+class CollectedSeasonEpisode(TypedDict):
+    number: int  # Episode number
+    collected_at: str  # "2019-09-24T09:03:22.000Z"
+
+
+class CollectedSeason(SeasonBare):
+    episodes: list[CollectedSeasonEpisode]
+
+
 class CollectedShow(Show):
     last_collected_at: str  # "2019-09-24T09:03:22.000Z"
     last_updated_at: str  # "2019-09-24T09:03:22.000Z"
     show: Show
+    seasons: list[CollectedSeason]
 
 
 class CollectedMovie(Movie):
@@ -289,7 +305,7 @@ class ExtendedMovieRow(MovieRow):
 
 
 class CollectedMediaRow(TypedDict):
-    # id: str  # Primary Key
+    # Primary Key : (type, media_id).
     media_id: int
     collected_at: str  # "2019-09-24T09:03:22.000Z"
 
@@ -324,7 +340,7 @@ class HistoryMovieRow(HistoryMediaRow):
 
 
 class RatedMediaRow(TypedDict):
-    # id: str  # Primary Key : will be auto generated while writing it to db.
+    # Primary Key : (type, media_id).
     media_id: int
     rating: int
     rated_at: str  # "2019-09-24T09:03:22.000Z"